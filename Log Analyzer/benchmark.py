@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import gzip
+import json
+import math
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from multiprocessing import Pipe, Process
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+from log_analyzer import (
+    DEFAULT_CONFIG, LOG_PREFIX, create_report, enrich_url_statistics, np, parse_log, peak_rss, read_log,
+    top_url_statistics, url_partitions
+)
+
+# Row of the generated log in the ui_short format
+LOG_ROW = ('{ip} -  - [{time} +0300] "GET {url} HTTP/1.1" {status} {size} "-" "Lynx/2.8.8dev.9 libwww-FM/2.14" "-" '
+           '"{request_id}" "-" {request_time:.3f}\n')
+# Statuses of the generated requests and their weights
+STATUSES = (('200', 90), ('404', 6), ('500', 3), ('502', 1))
+# Latency distributions of the generator with the given mean request time
+LATENCY_DISTRIBUTIONS = {
+    'exponential': lambda rng, mean: rng.expovariate(1 / mean),
+    'lognormal': lambda rng, mean: rng.lognormvariate(math.log(mean) - .5, 1.),
+    'pareto': lambda rng, mean: mean / 3 * rng.paretovariate(1.5),
+}
+# Date of the last generated log
+LAST_LOG_DATE = date(2017, 6, 30)
+# Config parameters which are recorded with the results
+BENCHMARK_PARAMS = ('WORKERS', 'ENGINE', 'BINARY', 'PIPELINE', 'MAX_URLS', 'SPILL_URLS', 'URL_NORMALIZE',
+                    'TIME_BUCKET', 'GROUP_BY', 'REPORT_SIZE')
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    This function creates args of the benchmark
+    :return: args(Namespace): parsed args
+    """
+    parser = argparse.ArgumentParser(description='Benchmark of log_analyzer on generated logs')
+    parser.add_argument('--log-dir', help='dir of the generated logs, a temporary dir by default')
+    parser.add_argument('--lines', type=int, default=100000, help='lines of each log')
+    parser.add_argument('--urls', type=int, default=10000, help='number of distinct urls')
+    parser.add_argument('--days', type=int, default=1, help='number of logs of each format')
+    parser.add_argument('--formats', default='plain,gz', help='formats of the logs: plain, gz')
+    parser.add_argument('--latency', choices=sorted(LATENCY_DISTRIBUTIONS), default='lognormal',
+                        help='distribution of request time')
+    parser.add_argument('--mean-time', type=float, default=.3, help='mean request time')
+    parser.add_argument('--seed', default='1', help='seed of the generator')
+    parser.add_argument('--repeat', type=int, default=1, help='runs of each log, the best time is recorded')
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE',
+                        help='log_analyzer config parameter, e.g. WORKERS=4')
+    parser.add_argument('--output', default='benchmark.json', help='path to the JSON results')
+    parser.add_argument('--baseline', help='path to the JSON results to compare with')
+    return parser.parse_args(args)
+
+
+def generate_log(path: Path, lines: int, urls: int, latency: str = 'lognormal', mean_time: float = .3,
+                 seed: str = '1') -> Path:
+    """
+    This function writes a log of lines rows for one day. Popularity of
+    urls follows the Zipf law. The log depends only on the parameters and
+    the name of the file, so a plain and a gz log of the same date are equal
+    :return: path(Path): path of the log
+    """
+    rng = random.Random('{}-{}'.format(seed, path.stem if path.suffix in ('.gz', '.plain') else path.name))
+    request_time = LATENCY_DISTRIBUTIONS[latency]
+    url_weights = [1 / rank for rank in range(1, urls + 1)]
+    day = datetime.strptime(path.name.split('-')[-1][:8], '%Y%m%d')
+    statuses, status_weights = zip(*STATUSES)
+    opener = gzip.open if path.suffix == '.gz' else open
+    with opener(path, 'wt', encoding='utf-8') as log:
+        time_local = None
+        second = -1
+        for line, url in enumerate(rng.choices(range(urls), url_weights, k=lines)):
+            if line * 86400 // lines != second:
+                second = line * 86400 // lines
+                time_local = (day + timedelta(seconds=second)).strftime('%d/%b/%Y:%H:%M:%S')
+            log.write(LOG_ROW.format(
+                ip='1.{}.{}.{}'.format(rng.randrange(256), rng.randrange(256), rng.randrange(256)),
+                time=time_local, url='/api/v2/banner/{}'.format(url),
+                status=rng.choices(statuses, status_weights)[0], size=rng.randrange(100, 20000),
+                request_id='{}-{}'.format(int(day.timestamp()) + second, rng.getrandbits(32)),
+                request_time=request_time(rng, mean_time)))
+    return path
+
+
+def generate_logs(log_dir: Path, days: int, formats: List[str], **params) -> List[Path]:
+    """
+    This function writes logs of each format for days up to LAST_LOG_DATE
+    :return: logs(list): paths of the logs
+    """
+    logs = []
+    for day in range(days):
+        name = '{}.log-{}'.format(LOG_PREFIX, (LAST_LOG_DATE - timedelta(days=day)).strftime('%Y%m%d'))
+        for log_format in formats:
+            logs.append(generate_log(log_dir / '{}.{}'.format(name, log_format), **params))
+    return logs
+
+
+def benchmark_log(file: str, file_config: Dict, report_path: Path) -> Dict:
+    """
+    This function measures the stages of the report of the log. Rows are
+    read without parsing, then the log is parsed and the report is built.
+    Peak RSS of the process or of its largest worker is taken after the
+    stages, it is 0 on platforms without the resource module
+    :return: result(dict): lines, urls, stage times, lines per second and peak RSS
+    """
+    stages = {}
+    start = time.perf_counter()
+    lines = sum(1 for _ in read_log(file, bool(int(file_config['BINARY']))))
+    stages['read_log'] = time.perf_counter() - start
+    start = time.perf_counter()
+    urls_list, sum_requests, sum_requests_time = parse_log(file, file_config)
+    stages['parse_log'] = time.perf_counter() - start
+    top = []
+    for part in url_partitions(urls_list):
+        top = top_url_statistics(part, int(file_config['REPORT_SIZE']), top)
+    start = time.perf_counter()
+    report = enrich_url_statistics(top, sum_requests, sum_requests_time)
+    stages['enrich_url_statistics'] = time.perf_counter() - start
+    start = time.perf_counter()
+    create_report(report, report_path)
+    stages['create_report'] = time.perf_counter() - start
+    return {
+        'lines': lines,
+        'requests': sum_requests,
+        'urls': len(urls_list),
+        'stages': stages,
+        'lines_per_sec': lines / stages['parse_log'] if stages['parse_log'] else .0,
+        'peak_rss_kb': peak_rss() // 1024
+    }
+
+
+def run_isolated(func: Callable, *args):
+    """
+    This function runs the function in a new process, so the peak RSS
+    is of the one run. The process is not a daemon and may start WORKERS
+    :return: result: the result of the function
+    """
+    receiver, sender = Pipe(duplex=False)
+    process = Process(target=_send_result, args=(sender, func) + args)
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if result is None:
+        raise RuntimeError('Benchmark process failed with exit code {}'.format(process.exitcode))
+    return result
+
+
+def _send_result(sender, func: Callable, *args) -> None:
+    sender.send(func(*args))
+    sender.close()
+
+
+def benchmark_logs(logs: List[Path], file_config: Dict, repeat: int = 1) -> List[Dict]:
+    """
+    This function benchmarks the logs repeat times. The best time of each
+    stage and the largest peak RSS of the runs are recorded
+    :return: results(list): results of the logs
+    """
+    results = []
+    with tempfile.TemporaryDirectory() as report_dir:
+        for log in logs:
+            runs = [run_isolated(benchmark_log, str(log), file_config, Path(report_dir) / 'report.html')
+                    for _ in range(repeat)]
+            result = dict(runs[0], file=log.name, bytes=log.stat().st_size)
+            result['stages'] = {stage: min(run['stages'][stage] for run in runs) for stage in result['stages']}
+            result['lines_per_sec'] = max(run['lines_per_sec'] for run in runs)
+            result['peak_rss_kb'] = max(run['peak_rss_kb'] for run in runs)
+            results.append(result)
+    return results
+
+
+def git_commit() -> str:
+    """
+    This function gets the commit of the benchmarked code
+    :return: commit(str): hash of HEAD, empty if it is unknown
+    """
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=str(Path(__file__).resolve().parent),
+                              stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+def compare_results(results: Dict, baseline: Dict) -> List[str]:
+    """
+    This function compares stage times of the logs present in both results
+    :return: lines(list): change of each stage in percents
+    """
+    baseline_logs = {log['file']: log for log in baseline['logs']}
+    lines = []
+    for log in results['logs']:
+        base = baseline_logs.get(log['file'])
+        if base is None:
+            continue
+        for stage, seconds in log['stages'].items():
+            base_seconds = base['stages'].get(stage)
+            if base_seconds:
+                lines.append('{} {}: {:.3f}s -> {:.3f}s ({:+.1f}%)'.format(
+                    log['file'], stage, base_seconds, seconds, (seconds / base_seconds - 1) * 100))
+        lines.append('{} peak RSS: {} KB -> {} KB'.format(log['file'], base['peak_rss_kb'], log['peak_rss_kb']))
+    return lines
+
+
+def main(args: argparse.Namespace) -> Dict:
+    """
+    This function generates the logs, benchmarks them and writes results
+    :return: results(dict): the written results
+    """
+    file_config = dict(DEFAULT_CONFIG, CACHE_DIR='')
+    for item in args.set:
+        name, _, value = item.partition('=')
+        file_config[name.strip().upper()] = value.strip()
+    generator = {'lines': args.lines, 'urls': args.urls, 'latency': args.latency, 'mean_time': args.mean_time,
+                 'seed': args.seed}
+    formats = [log_format.strip() for log_format in args.formats.split(',') if log_format.strip()]
+    with tempfile.TemporaryDirectory() as temp_dir:
+        log_dir = Path(args.log_dir or temp_dir)
+        log_dir.mkdir(parents=True, exist_ok=True)
+        logs = generate_logs(log_dir, args.days, formats, **generator)
+        results = {
+            'commit': git_commit(),
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'numpy': np is not None,
+            'generator': dict(generator, days=args.days, formats=formats),
+            'config': {name: file_config[name] for name in BENCHMARK_PARAMS},
+            'logs': benchmark_logs(logs, file_config, args.repeat)
+        }
+    with open(args.output, 'w', encoding='utf-8') as output:
+        json.dump(results, output, indent=2)
+    for log in results['logs']:
+        sys.stdout.write('{file}: {lines} lines, {lines_per_sec:.0f} lines/s, peak RSS {peak_rss_kb} KB\n'.format(**log))
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as baseline:
+            sys.stdout.write('\n'.join(compare_results(results, json.load(baseline))) + '\n')
+    return results
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -2,46 +2,499 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import fnmatch
 import gzip
+import hashlib
+import heapq
+import io
 import json
 import logging
+import math
+import mmap
+import os
+import pickle
+import queue
+import random
 import re
-import statistics
+import shutil
+import signal
+import sqlite3
+import struct
+import subprocess
 import sys
+import tempfile
+import threading
+import time
+import weakref
+import zlib
+from collections import deque
+from contextlib import closing, contextmanager, nullcontext
+from functools import lru_cache, partial
+from itertools import chain
 from configparser import RawConfigParser
+from datetime import date, datetime, timedelta, timezone
 from logging import config
+from operator import itemgetter
+from multiprocessing import Pool
 from pathlib import Path
-from typing import Dict, Generator, List, Tuple
+from typing import Callable, Dict, FrozenSet, Generator, IO, Iterable, List, Optional, Tuple
 
-# log_format ui_short '$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
-#                     '$status $body_bytes_sent "$http_referer" '
-#                     '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
-#                     '$request_time';
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# nginx log_format of the ui_short logs
+UI_SHORT_FORMAT = ('$remote_addr  $remote_user $http_x_real_ip [$time_local] "$request" '
+                   '$status $body_bytes_sent "$http_referer" '
+                   '"$http_user_agent" "$http_x_forwarded_for" "$http_X_REQUEST_ID" "$http_X_RB_USER" '
+                   '$request_time')
 
 DEFAULT_CONFIG = {
     'REPORT_SIZE': 1000,
     'REPORT_DIR': './reports',
-    'LOG_DIR': './log'
+    'LOG_DIR': './log',
+    'LOGS_COUNT': 1,
+    'WORKERS': 1,
+    'QUANTILE_ACCURACY': 0.01,
+    'LOG_FORMAT': UI_SHORT_FORMAT,
+    'CACHE_DIR': None,
+    'ROLLUP': '',
+    'MAX_URLS': 0,
+    'URL_NORMALIZE': '',
+    'URL_CACHE_SIZE': 100000,
+    'PIPELINE': 0,
+    'PIGZ': 'pigz',
+    'BINARY': 0,
+    'ENGINE': 'python',
+    'INCREMENTAL': 0,
+    'WATCH': 0,
+    'WATCH_INTERVAL': 10,
+    'TIME_BUCKET': '',
+    'SAMPLE': 0,
+    'SAMPLE_SEED': '',
+    'SPILL_URLS': 0,
+    'SPILL_PARTITIONS': 16,
+    'SPILL_DIR': '',
+    'GROUP_BY': 'request',
+    'PIVOT': '',
+    'MAX_PARSE_ERRORS': 0,
+    'PROGRESS_ROWS': 1000000,
+    'METRICS_JSON': '',
+    'METRICS_TEXTFILE': '',
+    'PARALLEL_LOGS': 1,
+    'PARALLEL_LOGS_BYTES': 0,
+    'REPORT_SIDECAR': 0,
+    'STORE_DB': ''
 }
+# Quantiles of request time in the report
+QUANTILES = {'med': .5, 'p90': .9, 'p95': .95, 'p99': .99}
+# Version of the aggregates cache file layout
+CACHE_VERSION = 4
+# Cache dir in REPORT_DIR unless CACHE_DIR is set
+CACHE_DIR_NAME = '.cache'
+# Start of the cache files
+CACHE_MAGIC = b'LACACHE\0'
+CACHE_LENGTH = struct.Struct('<I')
+# Statistics of a url in the cache file: count, time_sum, time_max, time_sum_error (nan if None),
+# number of points of the series and lengths of the url and of the serialized sketch
+CACHE_STAT = struct.Struct('<qdddIII')
+CACHE_BUCKET = struct.Struct('<q')
+# Config parameters which change aggregates of a log
+AGGREGATION_PARAMS = ('LOG_FORMAT', 'QUANTILE_ACCURACY', 'MAX_URLS', 'URL_NORMALIZE', 'TIME_BUCKET', 'GROUP_BY')
+# Errors of reading a log: the file is missing or unreadable, gzip data is truncated or corrupted
+READ_ERRORS = (OSError, EOFError, zlib.error)
+# Invalid UTF-8 bytes of rows are decoded to lone surrogates, so such rows are found and skipped as malformed
+DECODE_ERRORS = 'surrogateescape'
+# Number of bytes before the checkpoint offset which are compared to detect a rewritten log
+CHECKPOINT_TAIL_SIZE = 256
+# Size of blocks of plain log read at random offsets in sampling mode and z-score of confidence intervals
+SAMPLE_BLOCK_SIZE = 64 * 1024
+CONFIDENCE_Z = 1.96
+# Size of decompressed gzip block sent to a worker in parallel mode
+GZIP_BLOCK_SIZE = 16 * 1024 * 1024
+# Size of block read by the producer thread in pipeline mode and number of blocks in the queue
+PIPELINE_BLOCK_SIZE = 1024 * 1024
+PIPELINE_QUEUE_SIZE = 8
+# Number of rows aggregated at once by the numpy engine
+NUMPY_BATCH_SIZE = 1000000
+# Prefix and suffixes of nginx log names
+LOG_PREFIX = 'nginx-access-ui'
+LOG_SUFFIXES = ('.gz', '.plain')
 # Regular expression for parsing date in nginx log name
 DATE_PATTERN = re.compile(r'.*(?P<Y>\d{4})(?P<m>\d{2})(?P<d>\d{2})')
-# Regular expression for parsing row in nginx log
-ROW_PATTERN = re.compile(
-    r'(?P<remote_addr>\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3})\s(?P<remote_user>\S+)\s+(?P<http_x_real_ip>\S+)\s+'
-    r'\[(?P<time_local>.+)\]\s+"(?P<request>.*?)"\s+(?P<status>\d{3})\s+(?P<body_bytes_sent>\d+)\s+'
-    r'"(?P<http_referer>.+)"\s+"(?P<http_user_agent>.+)"\s+"(?P<http_x_forwarded_for>.+)"\s+'
-    r'"(?P<http_X_REQUEST_ID>.+)"\s+"(?P<http_X_RB_USER>.+)"\s+(?P<request_time>.+)'
+# Regular expression for rollup period
+ROLLUP_PATTERN = re.compile(r'(?P<days>\d+)d')
+# Regular expression for variables in nginx log_format
+FORMAT_VARIABLE_PATTERN = re.compile(r'\$(?:\{(\w+)\}|(\w+))')
+# Number of words in values of nginx variables which contain spaces
+VARIABLE_WORDS = {'time_local': 2}
+# Variables of the log row used in aggregation
+ROW_FIELDS = ('request', 'request_time')
+# Number of the most frequent values of PIVOT which get own columns in the report
+PIVOT_SIZE = 10
+# Stages of the run in the metrics, read, parse and aggregation of rows are one pass and are timed as parse
+METRIC_STAGES = ('discovery', 'parse', 'aggregate', 'enrich', 'render')
+# Prefix of the names of the metrics in the Prometheus textfile
+METRIC_PREFIX = 'log_analyzer'
+# Template of the report, it is found next to the script
+REPORT_TEMPLATE = str(Path(__file__).resolve().parent / 'templates' / 'report.html')
+# Placeholders of JSON values in the report template
+TEMPLATE_PLACEHOLDER_PATTERN = re.compile(r'\$(\w+_json)')
+# Rows of the report serialized to JSON at once
+JSON_BATCH_SIZE = 1000
+# Header of a serialized quantile sketch: accuracy, zeros and number of buckets
+SKETCH_HEADER = struct.Struct('<dqI')
+# Version of the schema of STORE_DB, it is kept in user_version of the database
+STORE_VERSION = 1
+STORE_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS days (day TEXT PRIMARY KEY, log TEXT NOT NULL, requests INTEGER NOT NULL, '
+    'time_sum REAL NOT NULL, accuracy REAL NOT NULL)',
+    'CREATE TABLE IF NOT EXISTS url_stats (url TEXT NOT NULL, day TEXT NOT NULL, count INTEGER NOT NULL, '
+    'time_sum REAL NOT NULL, time_max REAL NOT NULL, sketch BLOB NOT NULL, PRIMARY KEY (day, url)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS url_stats_url ON url_stats (url)',
+    # Covers top-N queries over days without reading the sketches
+    'CREATE INDEX IF NOT EXISTS url_stats_day ON url_stats (day, time_sum, count, time_max)',
 )
+# Seconds to wait for the lock of STORE_DB written by other processes
+STORE_TIMEOUT = 60
+# Formats and lengths of $time_local prefixes which define the time bucket of TIME_BUCKET
+TIME_BUCKETS = {'minute': ('%d/%b/%Y:%H:%M', 17), 'hour': ('%d/%b/%Y:%H', 14)}
+# Length of the time zone at the end of $time_local and size of the cache of time buckets
+TIME_ZONE_SIZE = 5
+TIME_CACHE_SIZE = 4096
+# Url path segments which are replaced by placeholders in URL_NORMALIZE, checked in this order
+URL_SEGMENT_PATTERNS = {
+    'uuid': (re.compile(r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'), '{uuid}'),
+    'id': (re.compile(r'\d+'), '{id}'),
+    'hex': (re.compile(r'(?=[a-fA-F]*\d)[0-9a-fA-F]{8,}'), '{hex}'),
+}
+# Steps of URL_NORMALIZE
+URL_NORMALIZE_STEPS = frozenset(('query',) + tuple(URL_SEGMENT_PATTERNS))
+
+
+LOGGER = logging.getLogger('ParserWork')
+
+
+class QuantileSketch:
+    """
+    Streaming quantiles of request time. Values are counted in logarithmic
+    buckets, so any quantile is estimated with the relative error not more
+    than accuracy and the memory depends on the range of values only.
+    Sketches with the same accuracy can be merged.
+    """
+    __slots__ = ('accuracy', 'gamma', 'gamma_log', 'buckets', 'zeros', 'count')
+
+    def __init__(self, accuracy: float = DEFAULT_CONFIG['QUANTILE_ACCURACY']):
+        self.accuracy = accuracy
+        self.gamma = (1 + accuracy) / (1 - accuracy)
+        self.gamma_log = math.log(self.gamma)
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, QuantileSketch):
+            return NotImplemented
+        return (self.accuracy, self.zeros, self.count, self.buckets) == \
+               (other.accuracy, other.zeros, other.count, other.buckets)
+
+    def add(self, value: float) -> None:
+        if value > 0:
+            key = math.ceil(math.log(value) / self.gamma_log)
+            self.buckets[key] = self.buckets.get(key, 0) + 1
+        else:
+            self.zeros += 1
+        self.count += 1
+
+    def merge(self, other: 'QuantileSketch') -> None:
+        if other.accuracy != self.accuracy:
+            raise ValueError('Sketches with different accuracy can not be merged')
+        for key, count in other.buckets.items():
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+
+    def quantile(self, q: float) -> float:
+        return self.quantiles((q,))[0]
+
+    def square_sum(self) -> float:
+        """
+        This method estimates the sum of squares of the values
+        :return: square_sum(float)
+        """
+        return math.fsum(count * (2 * self.gamma ** key / (self.gamma + 1)) ** 2 for key, count in self.buckets.items())
+
+    def quantiles(self, qs: Iterable[float]) -> List[float]:
+        """
+        This method estimates several quantiles in one pass over the sorted buckets
+        :return: values(list): estimates in the order of qs
+        """
+        ranks = sorted((q * (self.count - 1), i) for i, q in enumerate(qs))
+        values = [.0] * len(ranks)
+        seen = self.zeros
+        pending = [(rank, i) for rank, i in ranks if rank >= seen]
+        keys = iter(sorted(self.buckets))
+        for rank, i in pending:
+            while seen <= rank:
+                key = next(keys, None)
+                if key is None:
+                    return values
+                seen += self.buckets[key]
+            values[i] = 2 * self.gamma ** key / (self.gamma + 1)
+        return values
+
+    def to_bytes(self) -> bytes:
+        """
+        This method serializes the sketch: SKETCH_HEADER is followed by the
+        keys of the buckets as int32 and their counts as int64, little-endian
+        :return: data(bytes)
+        """
+        keys = sorted(self.buckets)
+        return SKETCH_HEADER.pack(self.accuracy, self.zeros, len(keys)) + \
+            struct.pack('<{0}i{0}q'.format(len(keys)), *keys, *(self.buckets[key] for key in keys))
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'QuantileSketch':
+        """
+        This method restores the sketch serialized by to_bytes
+        :return: sketch(QuantileSketch)
+        """
+        accuracy, zeros, size = SKETCH_HEADER.unpack_from(data)
+        values = struct.unpack_from('<{0}i{0}q'.format(size), data, SKETCH_HEADER.size)
+        sketch = cls(accuracy)
+        sketch.buckets = dict(zip(values[:size], values[size:]))
+        sketch.zeros = zeros
+        sketch.count = zeros + sum(values[size:])
+        return sketch
+
+
+class UrlStat:
+    """
+    Statistics of one url. The record has slots instead of a dict and
+    time_sum is not rounded until the report. time_sum_error is None
+    unless the url is in HeavyHitters. series holds statistics of the url
+    by the start of time bucket if TIME_BUCKET is set. url is the request
+    or the tuple of values of GROUP_BY fields
+    """
+    __slots__ = ('url', 'count', 'time_sum', 'time_max', 'med', 'time_sum_error', 'series')
+
+    def __init__(self, url: str, accuracy: float = DEFAULT_CONFIG['QUANTILE_ACCURACY']):
+        self.url = url
+        self.count = 0
+        self.time_sum = .0
+        self.time_max = .0
+        self.med = QuantileSketch(accuracy)
+        self.time_sum_error = None
+        self.series = None
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, UrlStat):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self) -> str:
+        return 'UrlStat({!r}, count={}, time_sum={})'.format(self.url, self.count, self.time_sum)
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        self.time_sum += value
+        if value > self.time_max:
+            self.time_max = value
+        self.med.add(value)
+
+
+class HeavyHitters(dict):
+    """
+    Statistics of urls limited to max_urls entries with the largest time_sum
+    (weighted Space-Saving). When the table is full, a new url replaces the url
+    with the least time_sum and inherits its time_sum as time_sum_error, so the
+    true time_sum of a url in the table is between time_sum - time_sum_error
+    and time_sum. A url which is not in the table has the true time_sum not
+    more than floor, and floor is not more than the total time / max_urls.
+    count, time_max and quantiles of a replacing url are counted since it was
+    added to the table.
+    """
+
+    def __init__(self, max_urls: int):
+        super().__init__()
+        self.max_urls = max_urls
+        self.floor = .0
+        # Difference between the total request time and the sum of time_sum in the table
+        self.time_correction = .0
+        self._heap = []
+
+    def replace_least(self, url: str) -> None:
+        """
+        This method makes room for the url just added to the table
+        """
+        stat = self[url]
+        stat.time_sum_error = .0
+        if len(self) > self.max_urls:
+            least = self._pop_least()
+            self.floor = max(self.floor, least.time_sum)
+            stat.time_sum += least.time_sum
+            stat.time_sum_error = least.time_sum
+        heapq.heappush(self._heap, (stat.time_sum, url))
 
+    def _pop_least(self) -> UrlStat:
+        # Heap entries are not updated with time_sum, stale ones are pushed back on the way
+        while True:
+            time_sum, url = heapq.heappop(self._heap)
+            if url not in self:
+                continue
+            if self[url].time_sum != time_sum:
+                heapq.heappush(self._heap, (self[url].time_sum, url))
+                continue
+            return self.pop(url)
 
-LOGGER = None
+    def merge(self, part_urls: 'HeavyHitters') -> None:
+        """
+        This method merges the table of a part of log. A url absent in one
+        of the tables may have up to its floor there, so the floor is added
+        to time_sum and time_sum_error of the url
+        """
+        if part_urls.floor:
+            for url, stat in self.items():
+                if url not in part_urls:
+                    _add_time_sum_error(stat, part_urls.floor)
+                    self.time_correction -= part_urls.floor
+        for url, part in part_urls.items():
+            if url in self:
+                _merge_url(self[url], part)
+            else:
+                self[url] = part
+                if self.floor:
+                    _add_time_sum_error(part, self.floor)
+                    self.time_correction -= self.floor
+        self.floor += part_urls.floor
+        self.time_correction += part_urls.time_correction
+        self.truncate()
+
+    def truncate(self) -> None:
+        """
+        This method keeps max_urls urls with the largest time_sum
+        """
+        if len(self) > self.max_urls:
+            kept = {stat.url for stat in heapq.nlargest(self.max_urls, self.values(), key=lambda stat: stat.time_sum)}
+            for url in [url for url in self if url not in kept]:
+                stat = self.pop(url)
+                self.floor = max(self.floor, stat.time_sum)
+                self.time_correction += stat.time_sum
+        self._heap = [(stat.time_sum, url) for url, stat in self.items()]
+        heapq.heapify(self._heap)
+
+
+class SpillTable(dict):
+    """
+    Statistics of urls which are spilled to disk when the table has more
+    than max_urls urls. Spilled statistics are hash-partitioned by url into
+    temporary files, so the statistics of one url are in one partition and
+    every partition is merged separately with exact results. The files are
+    removed with the table
+    """
+
+    def __init__(self, max_urls: int, partitions: int, spill_dir: str = ''):
+        super().__init__()
+        self.max_urls = max_urls
+        self.partitions = partitions
+        self.spill_dir = spill_dir
+        self.paths = []
+        # Sum of time_sum of the spilled statistics
+        self.time_spilled = .0
+        self._cleanup = None
+
+    @property
+    def spilled(self) -> bool:
+        return bool(self.paths)
+
+    def spill(self) -> None:
+        """
+        This method appends the statistics in memory to the partition files
+        and clears the table
+        """
+        if not self.paths:
+            temp_dir = tempfile.mkdtemp(prefix='log_analyzer-', dir=self.spill_dir or None)
+            self._cleanup = weakref.finalize(self, shutil.rmtree, temp_dir, ignore_errors=True)
+            self.paths = [os.path.join(temp_dir, 'partition-{}.pickle'.format(i)) for i in range(self.partitions)]
+        # Urls of binary mode are decoded, so that they are partitioned the same way as decoded urls
+        for stat in self.values():
+            _decode_url(stat)
+        for path, stats in zip(self.paths, self._partition(self.values())):
+            if stats:
+                with open(path, 'ab') as partition:
+                    pickle.dump(stats, partition, protocol=pickle.HIGHEST_PROTOCOL)
+        self.time_spilled += math.fsum(stat.time_sum for stat in self.values())
+        LOGGER.info('Statistics of {} urls are spilled to {}'.format(len(self), os.path.dirname(self.paths[0])))
+        self.clear()
+
+    def merge(self, part_urls: Dict) -> None:
+        """
+        This method merges the table of a part of log spilling when the table is full
+        """
+        for part in url_partitions(part_urls):
+            for url, stat in part.items():
+                if url in self:
+                    _merge_url(self[url], stat)
+                else:
+                    if len(self) >= self.max_urls:
+                        self.spill()
+                    self[url] = stat
+
+    def merged_partitions(self) -> Generator:
+        """
+        This generator method merges spilled statistics of each partition
+        with the statistics in memory
+        :return: urls_list(dict): statistics of the urls of the partition
+        """
+        if not self.paths:
+            yield dict(self)
+            return
+        for path, stats in zip(self.paths, self._partition(self.values())):
+            urls_list = {}
+            if os.path.exists(path):
+                with open(path, 'rb') as partition:
+                    while True:
+                        try:
+                            merge_url_statistics(urls_list, {stat.url: stat for stat in pickle.load(partition)})
+                        except EOFError:
+                            break
+            merge_url_statistics(urls_list, {stat.url: stat for stat in stats})
+            yield urls_list
+
+    def _partition(self, stats: Iterable[UrlStat]) -> List[List[UrlStat]]:
+        partitions = [[] for _ in range(self.partitions)]
+        for stat in stats:
+            partitions[hash(stat.url) % self.partitions].append(stat)
+        return partitions
+
+
+def url_partitions(urls_list: Dict) -> Iterable[Dict]:
+    """
+    This function gets the statistics of urls by partitions, which are
+    the partitions of the spilled table or the table itself
+    :return: partitions(iterable): dicts of urls statistics
+    """
+    if isinstance(urls_list, SpillTable) and urls_list.spilled:
+        return urls_list.merged_partitions()
+    return [urls_list]
+
+
+def _add_time_sum_error(stat: UrlStat, error: float) -> None:
+    stat.time_sum += error
+    stat.time_sum_error = (stat.time_sum_error or .0) + error
 
 
 def init_logger(config_path: str) -> None:
     """
     This function initiates logging parameters
     """
-    logging.config.fileConfig(config_path)
+    logging.config.fileConfig(config_path, disable_existing_loggers=False)
     global LOGGER
     LOGGER = logging.getLogger('ParserWork')
 
@@ -53,6 +506,9 @@ def parse_config_args() -> Dict:
     """
     parser = argparse.ArgumentParser()
     parser.add_argument('--config', default='./log_analyzer.conf', help='path to config')
+    parser.add_argument('--rollup', help='make one report for the logs of the period, e.g. 7d')
+    parser.add_argument('--watch', action='store_true', help='keep running and report new logs as they appear')
+    parser.add_argument('--sample', help='make preview reports from the share of log rows, e.g. 0.01')
     try:
         args = parser.parse_args()
     except:
@@ -70,169 +526,2230 @@ def parse_config_args() -> Dict:
                    file_config.items()}
     for item in set(DEFAULT_CONFIG.keys()).difference(set(file_config.keys())):
         file_config[item] = DEFAULT_CONFIG[item]
+    if args.rollup:
+        file_config['ROLLUP'] = args.rollup
+    if args.watch:
+        file_config['WATCH'] = 1
+    if args.sample:
+        file_config['SAMPLE'] = args.sample
+    if not valid_sample(file_config['SAMPLE']):
+        LOGGER.error('SAMPLE {} is wrong, it has to be a share of rows more than 0 and not more than 1'.format(
+            file_config['SAMPLE']))
+        return dict()
 
     return file_config
 
 
-def parse_logs(log_path: str,
-               log_pattern: str,
-               file_config: Dict) -> List[Path]:
+def valid_sample(sample: str) -> bool:
     """
-    This function function gets a list of the last LOGS_COUNT sorted log files
-    by date in their name with the extension gz or plain and the template
-    :return: log_files(list): List of files.
+    This function checks SAMPLE: 0 turns sampling off, otherwise it is
+    the share of rows 0 < SAMPLE <= 1
+    :return: bool
     """
-    log_files = Path(log_path).glob(log_pattern)
     try:
-        # Getting sorted by date in file name ext with gz or plain list type of WindowsPath
-        log_files = [sorted_file for sorted_file in
-                     sorted((file for file in log_files if file.suffix == '.gz' or file.suffix == '.plain'),
-                            key=lambda el: el.stem.split('.')[-1], reverse=True)][:int(file_config['LOGS_COUNT'])]
-        return log_files
+        sample = float(sample)
     except ValueError:
+        return False
+    return sample == 0 or 0 < sample <= 1
+
+
+def find_logs(log_path: str, log_pattern: str, count: int, file_config: Dict) -> List[Tuple[date, Path]]:
+    """
+    This function gets the last count log files by date in their name.
+    The newest logs are selected from the index of the dir by a heap
+    :return: logs(list): dates and paths of the logs, the newest first
+    """
+    try:
+        index = log_index(log_path, log_pattern, file_config)
+    except OSError:
         LOGGER.error('Getting nginx log files in {} is failed!'.format(log_path))
         return []
+    return [(date.fromordinal(day), Path(log_path) / name) for day, name in heapq.nlargest(count, index)]
+
+
+def log_index(log_path: str, log_pattern: str, file_config: Dict) -> List[Tuple[int, str]]:
+    """
+    This function lists logs of the dir matching the template with the
+    extension gz or plain by one os.scandir pass, dates are parsed from
+    their names once. The listing is cached in CACHE_DIR by the dir
+    modification time, which changes when files are added, removed or
+    renamed. A dir modified within a second of its listing is listed
+    again, since its mtime may not change for a file added in that second
+    :return: index(list): ordinals of dates and names of the logs
+    """
+    dir_stat = os.stat(log_path)
+    cache_path = log_index_cache_path(log_path, log_pattern, file_config)
+    cache_key = (CACHE_VERSION, log_pattern, dir_stat.st_mtime_ns)
+    cached = load_cache(cache_path, cache_key)
+    if cached is not None:
+        return [(ordinal, name) for ordinal, name in cached[0]['index']]
+    listed = time.time()
+    match = re.compile(fnmatch.translate(log_pattern)).match
+    index = []
+    with os.scandir(log_path) as entries:
+        for entry in entries:
+            name = entry.name
+            if not (name.endswith(LOG_SUFFIXES) and match(name)):
+                continue
+            log_name_date = DATE_PATTERN.match(name)
+            try:
+                day = date(int(log_name_date['Y']), int(log_name_date['m']), int(log_name_date['d']))
+                index.append((day.toordinal(), name))
+            except (TypeError, ValueError):
+                LOGGER.error('Log {} has no date in its name and is skipped'.format(name))
+    if cache_path and dir_stat.st_mtime < listed - 1:
+        save_cache(cache_path, cache_key, {'index': index})
+    return index
+
+
+def log_index_cache_path(log_path: str, log_pattern: str, file_config: Dict) -> Optional[Path]:
+    """
+    This function gets path of the listing cache file of the logs dir
+    :return: path(Path): path in CACHE_DIR or None if the cache is off
+    """
+    directory = cache_dir(file_config)
+    if directory is None:
+        return None
+    key = '{}\0{}'.format(Path(log_path).resolve(), log_pattern).encode('utf-8')
+    return directory / 'logs-{}.cache'.format(hashlib.sha1(key).hexdigest()[:16])
 
 
-def parse_log(file: str) -> Tuple[List, float, float]:
+def parse_log(file: str, file_config: Dict = DEFAULT_CONFIG, stats: Optional[Dict] = None) -> Tuple[Dict, int, float]:
     """
-    This function parsing nginx log file
+    This function parsing nginx log file. If WORKERS is more than one
+    the file is parsed by a pool of processes: a plain log is split into
+    chunks at line boundaries, a gzip log is decompressed and streamed
+    to the workers by blocks of lines. With PIPELINE on, a single process
+    log is read and decompressed in a separate thread while it is parsed.
+    With BINARY on, rows are parsed as bytes and only urls are decoded.
+    Aggregates of the log are saved to CACHE_DIR and loaded from there while
+    the log and the aggregation parameters are not changed. With INCREMENTAL
+    on, a plain log is parsed from the checkpoint offset. Malformed rows
+    are skipped up to MAX_PARSE_ERRORS, then parsing stops. The number of
+    malformed rows and the truncation are put to stats if it is given,
+    aggregates of a log with malformed rows are not cached.
     :return:
-        urls_list(list): list of urls.
+        urls_list(dict): dict of urls statistics.
         sum_requests(int): sum of requests
         sum_requests_time(float): sum of requests time
     """
-    urls_list = {}
+    stats = {} if stats is None else stats
+    stats.update(parse_errors=0, truncated=False, read_error=False, cached=False)
+    if int(file_config['INCREMENTAL']) and not file.endswith('gz') and checkpoint_path(file, file_config):
+        return parse_log_incremental(file, file_config, stats)
+    cache_key = aggregates_cache_key(file, file_config)
+    aggregates = load_aggregates(file, file_config, cache_key)
+    if aggregates is not None:
+        stats['cached'] = True
+        return aggregates
+    urls_list = new_url_statistics(file_config)
     sum_requests = 0
-    sum_requests_time = 0
-    log_rows = read_log(file)
-    try:
-        log_row = next(log_rows)
-        while log_row:
-            data = re.search(ROW_PATTERN, log_row)
-            calculate_url_statistics(urls_list, data.groupdict(0))
-            sum_requests += 1
-            sum_requests_time += float(data.groupdict(0)['request_time']) or .0
-            log_row = next(log_rows)
-    except:
-        log_row = None
+    errors = 0
+    workers = int(file_config['WORKERS'])
+    try:
+        if workers > 1:
+            with worker_pool(workers) as pool:
+                if file.endswith('gz'):
+                    parts = _imap_bounded(pool, partial(_aggregate_block, file_config=worker_config(file_config)),
+                                          read_log_blocks(file, pigz=file_config['PIGZ']), workers * 2)
+                else:
+                    parts = pool.imap(partial(_aggregate_chunk, file_config=worker_config(file_config)),
+                                      ((file, start, end) for start, end in split_log(file, workers)))
+                urls_list, sum_requests, errors = merge_parts(urls_list, guard_read_errors(parts, file, stats),
+                                                              file_config)
+        elif int(file_config['PIPELINE']):
+            with closing(read_log_pipelined(file, file_config['PIGZ'], int(file_config['BINARY']))) as log_rows:
+                urls_list, sum_requests, errors = aggregate_log_rows(guard_read_errors(log_rows, file, stats),
+                                                                     file_config)
+        else:
+            urls_list, sum_requests, errors = aggregate_log_rows(
+                guard_read_errors(read_log(file, int(file_config['BINARY'])), file, stats), file_config)
+    except READ_ERRORS as error:
+        record_read_error(file, error, stats)
+    if stats['read_error']:
+        cache_key = None
+    if record_parse_errors(file, errors, file_config, stats):
+        cache_key = None
+    sum_requests_time = total_request_time(urls_list)
+    if cache_key and not (isinstance(urls_list, SpillTable) and urls_list.spilled):
+        save_aggregates(file, file_config, cache_key, (urls_list, sum_requests, sum_requests_time))
     return urls_list, sum_requests, sum_requests_time
 
 
-def read_log(file_name: str) -> Generator:
+def merge_parts(urls_list: Dict, parts: Iterable[Tuple[Dict, int, int]], file_config: Dict) -> Tuple[Dict, int, int]:
     """
-    This generator function opening and read file
-    :return: row: row of file
+    This function merges aggregates of the parts of a log in the file order.
+    Parts after the part where MAX_PARSE_ERRORS is exceeded are not merged
+    as in single-process mode. Progress is logged every PROGRESS_ROWS rows
+    :return:
+        urls_list(dict): dict of urls statistics.
+        sum_requests(int): sum of requests
+        errors(int): number of malformed rows
     """
-    if file_name.endswith('gz'):
-        log = gzip.open(file_name, mode='rt', encoding='utf-8')
-    else:
-        log = open(file_name, 'r')
-    for row in log:
-        yield row
-    log.close()
+    sum_requests = 0
+    errors = 0
+    progress_rows = int(file_config['PROGRESS_ROWS'])
+    next_progress = progress_rows
+    started = time.perf_counter()
+    for part_urls, part_requests, part_errors in parts:
+        merge_url_statistics(urls_list, part_urls)
+        sum_requests += part_requests
+        errors += part_errors
+        if errors > int(file_config['MAX_PARSE_ERRORS']):
+            break
+        if progress_rows and sum_requests >= next_progress:
+            log_progress(sum_requests, started)
+            next_progress = (sum_requests // progress_rows + 1) * progress_rows
+    return urls_list, sum_requests, errors
+
+
+def record_parse_errors(file: str, errors: int, file_config: Dict, stats: Dict) -> int:
+    """
+    This function logs malformed rows of the log and puts them to stats.
+    Parsing of a log with more than MAX_PARSE_ERRORS malformed rows is
+    stopped, so its report is truncated
+    :return: errors(int): number of malformed rows
+    """
+    truncated = errors > int(file_config['MAX_PARSE_ERRORS'])
+    if truncated:
+        LOGGER.error('Parsing of {} is stopped after {} malformed rows, the report is truncated'.format(file, errors))
+    elif errors:
+        LOGGER.warning('{} malformed rows of {} are skipped'.format(errors, file))
+    stats['parse_errors'] += errors
+    stats['truncated'] = stats['truncated'] or truncated
+    return errors
+
+
+def guard_read_errors(items: Iterable, file: str, stats: Dict) -> Generator:
+    """
+    This generator function yields rows or parts of the log until a read
+    error, which is put to stats, so the items read before it are kept
+    :return: item: row or part of the log
+    """
+    try:
+        yield from items
+    except READ_ERRORS as error:
+        record_read_error(file, error, stats)
 
 
-def calculate_url_statistics(urls_list: List[str],
-                             log_line: Dict) -> None:
+def record_read_error(file: str, error: Exception, stats: Dict) -> None:
     """
-    This function calculating statistics for each unique url
+    This function logs the read error of the log and puts it to stats.
+    The log is truncated and its report is not built, so it is tried again
+    by the next run
     :return:
     """
-    url = log_line['request']
-    rt = float(log_line['request_time']) or 0.
-    if url not in urls_list:
-        urls_list[url] = {}
-        urls_list[url]['url'] = url
-        urls_list[url]['med'] = []
-        urls_list[url]['med'].append(rt)
-        urls_list[url]['count'] = 1
-        urls_list[url]['time_max'] = rt
-        urls_list[url]['time_sum'] = round(rt, 3)
-    else:
-        urls_list[url]['count'] += 1
-        urls_list[url]['med'].append(rt)
-        if rt > float(log_line['request_time']):
-            urls_list[url]['time_max'] = rt
-        urls_list[url]['time_sum'] = round(urls_list[url]['time_sum'] + rt, 3)
+    LOGGER.error('Error while reading {}: {}, the log is truncated'.format(file, error))
+    stats['read_error'] = True
+    stats['truncated'] = True
 
 
-def enrich_url_statistics(urls_list: List[str],
-                          sum_req: float,
-                          sum_req_time: float) -> List[float]:
+def log_progress(rows: int, started: float) -> None:
     """
-    This function enriching statistics for each unique url
-    :return: urls_list(list): list of urls with statistics
+    This function logs the number of parsed rows and the parse rate
+    :return:
     """
-    for el in urls_list:
-        try:
-            el['time_perc'] = round(el['time_sum'] / (sum_req_time / 100), 3)
-            el['time_avg'] = round(round(el['time_sum'] / (el['count'] / 100), 3) / 100, 3)
-            el['count_perc'] = round(el['count'] / (sum_req / 100), 3)
-            el['med'] = round(statistics.median(el['med']), 3)
-        except KeyError:
-            LOGGER.error(
-                'This columns is absent in the log: time_sum,med and count!'
-            )
-    return urls_list
+    elapsed = time.perf_counter() - started
+    LOGGER.info('{} rows are parsed, {:.0f} rows/s'.format(rows, rows / elapsed if elapsed else .0))
 
 
-def create_report(report: List[str], report_path: Path) -> None:
+def sample_log(file: str, file_config: Dict, stats: Optional[Dict] = None) -> Tuple[Tuple[Dict, int, float], float]:
     """
-    This function create report
+    This function parsing the SAMPLE share of nginx log file rows. A plain
+    log is read by blocks of SAMPLE_BLOCK_SIZE bytes at random offsets, rows
+    of a gzip log are taken at random. The rows are random each time or
+    the same ones if SAMPLE_SEED is set. Aggregates are not scaled.
+    Malformed rows are put to stats as in parse_log
     :return:
+        aggregates(tuple): urls_list, sum_requests, sum_requests_time of the sample
+        sample_rate(float): share of the rows in the sample
     """
+    sample_rate = float(file_config['SAMPLE'])
+    binary = int(file_config['BINARY'])
+    rnd = random.Random(file_config['SAMPLE_SEED'] or None)
+    stats = {} if stats is None else stats
+    stats.update(parse_errors=0, truncated=False, read_error=False, cached=False)
+    urls_list = new_url_statistics(file_config)
+    sum_requests = 0
+    errors = 0
     try:
-        with open('./templates/report.html', 'r', encoding='utf-8') as f:
-            template = f.read()
-    except:
-        LOGGER.error('Error while opening report.html')
-        return
+        if file.endswith('gz'):
+            log_rows = (row for row in read_log(file, binary) if rnd.random() < sample_rate)
+        else:
+            blocks = max(math.ceil(os.path.getsize(file) / SAMPLE_BLOCK_SIZE), 1)
+            starts = sorted(rnd.sample(range(blocks), min(max(round(blocks * sample_rate), 1), blocks)))
+            sample_rate = len(starts) / blocks
+            log_rows = read_log_sample(file, [block * SAMPLE_BLOCK_SIZE for block in starts], binary)
+        urls_list, sum_requests, errors = aggregate_log_rows(guard_read_errors(log_rows, file, stats), file_config)
+    except READ_ERRORS as error:
+        record_read_error(file, error, stats)
+    record_parse_errors(file, errors, file_config, stats)
+    return (urls_list, sum_requests, total_request_time(urls_list)), sample_rate
+
 
-    template = template.replace('$table_json', json.dumps(report))
+def parse_log_incremental(file: str, file_config: Dict, stats: Dict) -> Tuple[Dict, int, float]:
+    """
+    This function parsing rows appended to plain nginx log file since the
+    last run. The checkpoint of the log keeps its inode, the offset of the
+    parsed rows, the bytes before the offset and the aggregates. If the log
+    is rotated (other inode) or truncated (shorter than the offset or other
+    bytes before the offset) it is parsed from the start. The last row
+    without line end is left for the next run. Malformed rows of the
+    appended rows are put to stats.
+    :return:
+        urls_list(dict): dict of urls statistics.
+        sum_requests(int): sum of requests
+        sum_requests_time(float): sum of requests time
+    """
+    cache_path = checkpoint_path(file, file_config)
+    cache_key = checkpoint_key(file, file_config)
+    urls_list = new_url_statistics(file_config)
+    sum_requests = 0
+    offset = 0
     try:
-        with open(report_path, 'w', encoding='utf-8') as f:
-            f.write(template)
-    except:
-        LOGGER.error('Error while writing report.html')
-        return
+        stat = os.stat(file)
+        checkpoint = load_cache(cache_path, cache_key)
+        if checkpoint is not None:
+            (urls_list, sum_requests, _), offset = checkpoint[1], checkpoint[0]['offset']
+            if checkpoint[0]['inode'] != stat.st_ino or stat.st_size < offset or \
+                    read_log_tail(file, offset).hex() != checkpoint[0]['tail']:
+                LOGGER.info('{} is rotated or truncated, it is parsed from the start'.format(file))
+                urls_list = new_url_statistics(file_config)
+                sum_requests = 0
+                offset = 0
+        end = complete_rows_end(file, offset, stat.st_size)
+        if end > offset:
+            part_urls, part_requests, errors = aggregate_log_range(file, offset, end, file_config, stats)
+            merge_url_statistics(urls_list, part_urls)
+            sum_requests += part_requests
+            if errors > int(file_config['MAX_PARSE_ERRORS']):
+                cache_key = None
+            record_parse_errors(file, errors, file_config, stats)
+            LOGGER.info('{} bytes of {} are parsed from the offset {}'.format(end - offset, file, offset))
+            offset = end
+    except READ_ERRORS as error:
+        record_read_error(file, error, stats)
+    if stats['read_error']:
+        cache_key = None
+    sum_requests_time = total_request_time(urls_list)
+    if cache_key and not (isinstance(urls_list, SpillTable) and urls_list.spilled):
+        checkpoint = {'inode': stat.st_ino, 'offset': offset, 'tail': read_log_tail(file, offset).hex()}
+        save_cache(cache_path, cache_key, checkpoint, (urls_list, sum_requests, sum_requests_time))
+    return urls_list, sum_requests, sum_requests_time
 
 
-def main(file_config: Dict) -> None:
+def aggregate_log_range(file: str, start: int, end: int, file_config: Dict, stats: Dict) -> Tuple[Dict, int, int]:
     """
-    This function processes logs
+    This function calculating statistics of urls for the rows of plain log
+    between the offsets, by a pool of processes if WORKERS is more than one.
+    A read error is put to stats, the rows read before it are aggregated
     :return:
+        urls_list(dict): dict of urls statistics.
+        sum_requests(int): sum of requests
+        errors(int): number of malformed rows
     """
-    # Initiating configuration parameters
-    logs_dir = file_config['LOG_DIR']
-    report_template = 'report-{Y}.{m}.{d}.html'
-    log_template = 'nginx-access-ui*'
-    reports_dir = Path(file_config['REPORT_DIR'])
-    report_size = file_config['REPORT_SIZE']
-    # Get last log file
-    files = parse_logs(logs_dir, log_template, file_config)
-    # Parsing log files
-    if len(files) > 0:
+    workers = int(file_config['WORKERS'])
+    if workers <= 1:
+        return aggregate_log_rows(guard_read_errors(read_log_chunk(file, start, end, int(file_config['BINARY'])),
+                                                    file, stats), file_config)
+    with worker_pool(workers) as pool:
+        return merge_parts(new_url_statistics(file_config), guard_read_errors(pool.imap(
+            partial(_aggregate_chunk, file_config=worker_config(file_config)),
+            ((file, chunk_start, chunk_end) for chunk_start, chunk_end in split_log(file, workers, start, end))),
+            file, stats), file_config)
+
+
+def checkpoint_path(file: str, file_config: Dict) -> Optional[Path]:
+    """
+    This function gets path of the checkpoint file of the log
+    :return: path(Path): path in CACHE_DIR or None if the cache is off
+    """
+    cache_path = aggregates_cache_path(file, file_config)
+    return cache_path and cache_path.with_suffix('.checkpoint')
+
+
+def checkpoint_key(file: str, file_config: Dict) -> Tuple:
+    """
+    This function gets the key of the log checkpoint: the log path and
+    the aggregation parameters
+    :return: key(tuple)
+    """
+    return (CACHE_VERSION, str(Path(file).resolve())) + tuple(str(file_config[param]) for param in AGGREGATION_PARAMS)
+
+
+def read_log_tail(file: str, offset: int) -> bytes:
+    """
+    This function reads bytes of the log before the offset
+    :return: tail(bytes)
+    """
+    with open(file, 'rb') as log:
+        log.seek(max(offset - CHECKPOINT_TAIL_SIZE, 0))
+        return log.read(min(offset, CHECKPOINT_TAIL_SIZE))
+
+
+def complete_rows_end(file: str, start: int, size: int) -> int:
+    """
+    This function gets the offset after the last line end of the log
+    :return: end(int): offset, start if there are no complete rows after it
+    """
+    with open(file, 'rb') as log:
+        end = size
+        while end > start:
+            block_start = max(end - PIPELINE_BLOCK_SIZE, start)
+            log.seek(block_start)
+            block = log.read(end - block_start)
+            line_end = block.rfind(b'\n')
+            if line_end >= 0:
+                return block_start + line_end + 1
+            end = block_start
+    return start
+
+
+def aggregates_cache_path(file: str, file_config: Dict) -> Optional[Path]:
+    """
+    This function gets path of the aggregates cache file of the log
+    :return: path(Path): path in CACHE_DIR or None if the cache is off
+    """
+    directory = cache_dir(file_config)
+    if directory is None:
+        return None
+    return directory / '{}.cache'.format(Path(file).name)
+
+
+def cache_dir(file_config: Dict) -> Optional[Path]:
+    """
+    This function gets the cache dir: CACHE_DIR if it is set, otherwise
+    the dir .cache in REPORT_DIR, so the cache does not depend on the
+    working dir of the run
+    :return: path(Path): None if CACHE_DIR is empty and the cache is off
+    """
+    directory = file_config.get('CACHE_DIR')
+    if directory is None:
+        return Path(file_config['REPORT_DIR']) / CACHE_DIR_NAME
+    return Path(directory) if directory else None
+
+
+def aggregates_cache_key(file: str, file_config: Dict) -> Optional[Tuple]:
+    """
+    This function gets the key of the log aggregates: the log path, size and
+    modification time and the aggregation parameters
+    :return: key(tuple): key or None if the log is not available
+    """
+    try:
+        stat = os.stat(file)
+    except OSError:
+        return None
+    return (CACHE_VERSION, str(Path(file).resolve()), stat.st_size, stat.st_mtime_ns) + \
+        tuple(str(file_config[param]) for param in AGGREGATION_PARAMS)
+
+
+def has_aggregates(file: str, file_config: Dict) -> bool:
+    """
+    This function checks that the cache file holds actual aggregates of the log
+    :return: bool
+    """
+    cache_path = aggregates_cache_path(file, file_config)
+    cache_key = aggregates_cache_key(file, file_config)
+    if cache_path is None or cache_key is None or not cache_path.exists():
+        return False
+    try:
+        with open(cache_path, 'rb') as cache:
+            return read_cache_key(cache) == encode_cache_key(cache_key)
+    except (OSError, ValueError):
+        return False
+
+
+def rollup_logs(files: List[str], file_config: Dict, stats: Optional[Dict] = None) -> Tuple[Dict, int, float]:
+    """
+    This function merges aggregates of several logs. Logs which are not in
+    the cache are parsed by a pool of WORKERS processes, one log per process.
+    Malformed rows and read errors of the logs are summed in stats, the
+    logs are cached if all of them are cached
+    :return:
+        urls_list(dict): dict of urls statistics.
+        sum_requests(int): sum of requests
+        sum_requests_time(float): sum of requests time
+    """
+    stats = {} if stats is None else stats
+    stats.update(parse_errors=0, truncated=False, read_error=False, cached=True)
+    urls_list = new_url_statistics(file_config)
+    sum_requests = 0
+    missing = [file for file in files if not has_aggregates(file, file_config)]
+    workers = min(int(file_config['WORKERS']), len(missing))
+    with worker_pool(workers) if workers > 1 else nullcontext() as pool:
+        if pool:
+            parsed = pool.imap(partial(_parse_log_stats, file_config=dict(worker_config(file_config), WORKERS=1)),
+                               missing)
+        else:
+            parsed = map(partial(_parse_log_stats, file_config=file_config), missing)
         for file in files:
+            (part_urls, part_requests, _), part_stats = next(parsed) if file in missing else \
+                _parse_log_stats(file, file_config)
+            merge_url_statistics(urls_list, part_urls)
+            sum_requests += part_requests
+            stats['parse_errors'] += part_stats['parse_errors']
+            for name in ('truncated', 'read_error'):
+                stats[name] = stats[name] or part_stats[name]
+            stats['cached'] = stats['cached'] and part_stats['cached']
+    sum_requests_time = total_request_time(urls_list)
+    return urls_list, sum_requests, sum_requests_time
+
+
+def _parse_log_stats(file: str, file_config: Dict) -> Tuple[Tuple[Dict, int, float], Dict]:
+    stats = {}
+    return parse_log(file, file_config, stats), stats
+
+
+def worker_config(file_config: Dict) -> Dict:
+    """
+    This function gets the config for pool workers. Tables of the workers
+    are sent to the main process, so they are not spilled to disk there.
+    Progress of the parts is logged by the main process
+    :return: file_config(dict)
+    """
+    return dict(file_config, SPILL_URLS=0, PROGRESS_ROWS=0)
+
+
+def new_url_statistics(file_config: Dict) -> Dict:
+    """
+    This function creates the table of urls statistics. It is limited
+    to MAX_URLS urls if the parameter is set, otherwise it is spilled to
+    disk over SPILL_URLS urls if that parameter is set
+    :return: urls_list(dict)
+    """
+    max_urls = int(file_config['MAX_URLS'])
+    if max_urls > 0:
+        return HeavyHitters(max_urls)
+    spill_urls = int(file_config['SPILL_URLS'])
+    if spill_urls > 0:
+        return SpillTable(spill_urls, int(file_config['SPILL_PARTITIONS']), file_config['SPILL_DIR'])
+    return {}
+
+
+def total_request_time(urls_list: Dict) -> float:
+    """
+    This function gets the total request time of urls statistics
+    :return: sum_requests_time(float)
+    """
+    total = math.fsum(url.time_sum for url in urls_list.values())
+    if isinstance(urls_list, HeavyHitters):
+        total += urls_list.time_correction
+    if isinstance(urls_list, SpillTable):
+        total += urls_list.time_spilled
+    return round(total, 3)
+
+
+def load_aggregates(file: str, file_config: Dict, cache_key: Optional[Tuple]) -> Optional[Tuple]:
+    """
+    This function loads aggregates of the log from the cache file
+    :return: aggregates(tuple): urls_list, sum_requests, sum_requests_time or None
+    """
+    cache_path = aggregates_cache_path(file, file_config)
+    cached = load_cache(cache_path, cache_key)
+    if cached is None:
+        return None
+    LOGGER.info('Aggregates of {} are loaded from {}'.format(file, cache_path))
+    return cached[1]
+
+
+def save_aggregates(file: str, file_config: Dict, cache_key: Tuple, aggregates: Tuple) -> None:
+    """
+    This function saves aggregates of the log to the cache file
+    :return:
+    """
+    save_cache(aggregates_cache_path(file, file_config), cache_key, {}, aggregates)
+
+
+def load_cache(cache_path: Optional[Path], cache_key: Optional[Tuple]) -> Optional[Tuple[Dict, Optional[Tuple]]]:
+    """
+    This function loads the cache file. The file starts with the key, so
+    a stale file is rejected without reading the rest. The file holds JSON
+    and packed numbers only, nothing in it is executed
+    :return:
+        value(dict): JSON values of the file
+        aggregates(tuple): urls_list, sum_requests, sum_requests_time or None if the file has no aggregates
+    """
+    if cache_path is None or cache_key is None or not cache_path.exists():
+        return None
+    try:
+        with open(cache_path, 'rb') as cache:
+            if read_cache_key(cache) != encode_cache_key(cache_key):
+                return None
+            value = json.loads(read_cache_block(cache))
+            table = value.pop('table', None)
+            if table is None:
+                return value, None
+            return value, (read_url_statistics(cache.read(), table), table['requests'], table['time'])
+    except (OSError, ValueError, KeyError, TypeError, struct.error):
+        LOGGER.error('Error while reading cache {}'.format(cache_path))
+        return None
+
+
+def save_cache(cache_path: Optional[Path], cache_key: Tuple, value: Dict, aggregates: Optional[Tuple] = None) -> None:
+    """
+    This function saves the key, JSON values and, if they are given,
+    aggregates of urls to the cache file. Each url is a packed CACHE_STAT
+    followed by the url in JSON, its serialized sketch and its series
+    :return:
+    """
+    if cache_path is None:
+        return
+    try:
+        cache_path.parent.mkdir(exist_ok=True, parents=True)
+        with atomic_write(cache_path, 'wb') as cache:
+            cache.write(CACHE_MAGIC)
+            write_cache_block(cache, encode_cache_key(cache_key))
+            if aggregates is None:
+                write_cache_block(cache, json.dumps(value).encode('utf-8'))
+                return
+            urls_list, sum_requests, sum_requests_time = aggregates
+            table = {'requests': sum_requests, 'time': sum_requests_time, 'urls': len(urls_list)}
+            if isinstance(urls_list, HeavyHitters):
+                table.update(max_urls=urls_list.max_urls, floor=urls_list.floor,
+                             time_correction=urls_list.time_correction)
+            write_cache_block(cache, json.dumps(dict(value, table=table)).encode('utf-8'))
+            for stat in urls_list.values():
+                _write_stat(cache, stat)
+    except OSError:
+        LOGGER.error('Error while writing cache {}'.format(cache_path))
+
+
+def encode_cache_key(cache_key: Tuple) -> bytes:
+    return json.dumps(list(cache_key)).encode('utf-8')
+
+
+def read_cache_key(cache) -> bytes:
+    """
+    This function checks the start of the cache file and reads its key
+    :return: key(bytes): key in JSON
+    """
+    if cache.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+        raise ValueError('Not a cache file')
+    return read_cache_block(cache)
+
+
+def read_cache_block(cache) -> bytes:
+    length = cache.read(CACHE_LENGTH.size)
+    if len(length) < CACHE_LENGTH.size:
+        raise ValueError('Cache file is truncated')
+    return cache.read(CACHE_LENGTH.unpack(length)[0])
+
+
+def write_cache_block(cache, block: bytes) -> None:
+    cache.write(CACHE_LENGTH.pack(len(block)))
+    cache.write(block)
+
+
+def _write_stat(cache, stat: UrlStat, url: Optional[bytes] = None) -> None:
+    url = json.dumps(stat.url).encode('utf-8') if url is None else url
+    sketch = stat.med.to_bytes()
+    series = stat.series or {}
+    error = float('nan') if stat.time_sum_error is None else stat.time_sum_error
+    cache.write(CACHE_STAT.pack(stat.count, stat.time_sum, stat.time_max, error, len(series), len(url), len(sketch)))
+    cache.write(url)
+    cache.write(sketch)
+    for bucket, point in series.items():
+        cache.write(CACHE_BUCKET.pack(bucket))
+        # Points of the series have the url of their statistics
+        _write_stat(cache, point, b'')
+
+
+def read_url_statistics(data: bytes, table: Dict) -> Dict:
+    """
+    This function restores urls statistics saved by save_cache
+    :return: urls_list(dict)
+    """
+    urls_list = HeavyHitters(table['max_urls']) if 'max_urls' in table else {}
+    offset = 0
+    for _ in range(table['urls']):
+        stat, offset = _read_stat(data, offset)
+        urls_list[stat.url] = stat
+    if isinstance(urls_list, HeavyHitters):
+        urls_list.floor = table['floor']
+        urls_list.time_correction = table['time_correction']
+        urls_list.truncate()
+    if offset != len(data):
+        raise ValueError('Cache file has extra data')
+    return urls_list
+
+
+def _read_stat(data: bytes, offset: int, url=None) -> Tuple[UrlStat, int]:
+    count, time_sum, time_max, error, points, url_size, sketch_size = CACHE_STAT.unpack_from(data, offset)
+    offset += CACHE_STAT.size
+    if url is None:
+        url = json.loads(data[offset:offset + url_size])
+        url = tuple(url) if isinstance(url, list) else url
+    offset += url_size
+    med = QuantileSketch.from_bytes(data[offset:offset + sketch_size])
+    offset += sketch_size
+    stat = UrlStat(url, med.accuracy)
+    stat.count, stat.time_sum, stat.time_max, stat.med = count, time_sum, time_max, med
+    stat.time_sum_error = None if math.isnan(error) else error
+    if points:
+        stat.series = {}
+        for _ in range(points):
+            bucket = CACHE_BUCKET.unpack_from(data, offset)[0]
+            stat.series[bucket], offset = _read_stat(data, offset + CACHE_BUCKET.size, url)
+    return stat, offset
+
+
+@contextmanager
+def atomic_write(path: Path, mode: str = 'w') -> Generator:
+    """
+    This context manager writes the file to a temporary file of the process
+    and thread in its dir and renames it to the path on success. Readers
+    never see a half-written file and concurrent runs writing the same file
+    do not mix their writes
+    """
+    path = Path(path)
+    temp_path = path.with_name('{}.{}.{}.tmp'.format(path.name, os.getpid(), threading.get_ident()))
+    try:
+        with open(temp_path, mode, encoding=None if 'b' in mode else 'utf-8') as f:
+            yield f
+        os.replace(temp_path, path)
+    except BaseException:
+        try:
+            os.unlink(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def aggregate_log_rows(log_rows: Iterable[str], file_config: Dict = DEFAULT_CONFIG) -> Tuple[Dict, int, int]:
+    """
+    This function calculating statistics of urls for the rows of log.
+    Rows are bytes if BINARY is on, then urls are decoded once per distinct
+    url when the rows are done. Rows which are not valid UTF-8 or have
+    request_time which is not finite (inf, nan) are malformed.
+    Aggregation is stopped when malformed rows are over MAX_PARSE_ERRORS.
+    :return:
+        urls_list(dict): dict of urls statistics.
+        sum_requests(int): sum of requests
+        errors(int): number of malformed rows, aggregation stops when it is over MAX_PARSE_ERRORS
+    """
+    group_by = group_fields(file_config['GROUP_BY'], file_config['LOG_FORMAT'])
+    if file_config['ENGINE'] == 'numpy' and np is not None and not file_config['TIME_BUCKET'] and \
+            group_by == ('request',):
+        return aggregate_log_rows_numpy(log_rows, file_config)
+    urls_list = new_url_statistics(file_config)
+    sum_requests = 0
+    accuracy = float(file_config['QUANTILE_ACCURACY'])
+    binary = bool(int(file_config['BINARY']))
+    bucket = time_bucketer(file_config['TIME_BUCKET'], file_config['LOG_FORMAT'], binary)
+    fields = ROW_FIELDS + ('time_local',) if bucket else ROW_FIELDS
+    group_key = None
+    if group_by != ('request',):
+        # The key is the tuple of GROUP_BY values, the dict keeps one tuple per distinct key
+        fields += tuple(field for field in group_by if field not in fields)
+        group_key = itemgetter(*(fields.index(field) for field in group_by))
+    extract = compile_log_format(file_config['LOG_FORMAT'], fields, binary=binary)
+    normalize = url_normalizer(file_config['URL_NORMALIZE'], int(file_config['URL_CACHE_SIZE']), binary)
+    max_errors = int(file_config['MAX_PARSE_ERRORS'])
+    errors = 0
+    progress_rows = int(file_config['PROGRESS_ROWS'])
+    next_progress = progress_rows
+    started = time.perf_counter()
+    for log_row in log_rows:
+        row = extract(log_row) if log_row.isascii() or is_utf8(log_row) else None
+        if row is not None:
+            url = normalize(row[0]) if normalize else row[0]
+            try:
+                request_time = float(row[1]) or .0
+                if not math.isfinite(request_time):
+                    raise ValueError('request_time {} is not finite'.format(row[1]))
+                calculate_url_statistics(urls_list, group_key((url,) + row[1:]) if group_key else url,
+                                         request_time, accuracy, bucket(row[2]) if bucket else None)
+                sum_requests += 1
+                if sum_requests == next_progress:
+                    log_progress(sum_requests, started)
+                    next_progress += progress_rows
+                continue
+            except ValueError:
+                pass
+        errors += 1
+        if errors > max_errors:
+            break
+    if binary and (not normalize or group_key):
+        urls_list = decode_urls(urls_list)
+    return urls_list, sum_requests, errors
+
+
+def is_utf8(row) -> bool:
+    """
+    This function checks that the row which is not ASCII is valid UTF-8.
+    Rows of text mode are decoded with DECODE_ERRORS, so their invalid
+    bytes are lone surrogates which can not be encoded
+    :return: bool
+    """
+    try:
+        if isinstance(row, bytes):
+            row.decode('utf-8')
+        else:
+            row.encode('utf-8')
+    except UnicodeError:
+        return False
+    return True
+
+
+@lru_cache(maxsize=None)
+def group_fields(group_by: str, log_format: str) -> Tuple[str, ...]:
+    """
+    This function gets the fields of GROUP_BY. Fields which are not the
+    variables of the log_format are ignored
+    :return: fields(tuple): variables, ('request',) by default
+    """
+    variables = format_variables(log_format)
+    fields = tuple(field.strip() for field in group_by.split(',') if field.strip())
+    if set(fields) - variables:
+        LOGGER.error('Unknown GROUP_BY fields {} are ignored'.format(', '.join(sorted(set(fields) - variables))))
+        fields = tuple(field for field in fields if field in variables)
+    return tuple(dict.fromkeys(fields)) or ('request',)
+
+
+def aggregate_log_rows_numpy(log_rows: Iterable[str], file_config: Dict = DEFAULT_CONFIG) -> Tuple[Dict, int, int]:
+    """
+    This function calculating statistics of urls for the rows of log with
+    numpy. Rows are only parsed into url codes and request times, which are
+    aggregated by batches of NUMPY_BATCH_SIZE rows. The statistics are the
+    same as in aggregate_log_rows.
+    :return:
+        urls_list(dict): dict of urls statistics.
+        sum_requests(int): sum of requests
+        errors(int): number of malformed rows, aggregation stops when it is over MAX_PARSE_ERRORS
+    """
+    urls_list = new_url_statistics(file_config)
+    sum_requests = 0
+    accuracy = float(file_config['QUANTILE_ACCURACY'])
+    binary = bool(int(file_config['BINARY']))
+    extract = compile_log_format(file_config['LOG_FORMAT'], binary=binary)
+    normalize = url_normalizer(file_config['URL_NORMALIZE'], int(file_config['URL_CACHE_SIZE']), binary)
+    max_errors = int(file_config['MAX_PARSE_ERRORS'])
+    errors = 0
+    progress_rows = int(file_config['PROGRESS_ROWS'])
+    next_progress = progress_rows
+    started = time.perf_counter()
+    url_codes, url_code_list, request_times = {}, [], []
+    for log_row in log_rows:
+        row = extract(log_row) if log_row.isascii() or is_utf8(log_row) else None
+        try:
+            request_time = float(row[1]) or .0
+            if not math.isfinite(request_time):
+                raise ValueError('request_time {} is not finite'.format(row[1]))
+        except (TypeError, ValueError):
+            errors += 1
+            if errors > max_errors:
+                break
+            continue
+        url = normalize(row[0]) if normalize else row[0]
+        url_code = url_codes.get(url)
+        if url_code is None:
+            url_code = url_codes[url] = len(url_codes)
+        url_code_list.append(url_code)
+        request_times.append(request_time)
+        if len(request_times) == NUMPY_BATCH_SIZE:
+            _merge_batch(urls_list, url_codes, url_code_list, request_times, accuracy)
+            sum_requests += len(request_times)
+            url_codes, url_code_list, request_times = {}, [], []
+            if progress_rows and sum_requests >= next_progress:
+                log_progress(sum_requests, started)
+                next_progress = (sum_requests // progress_rows + 1) * progress_rows
+    if request_times:
+        _merge_batch(urls_list, url_codes, url_code_list, request_times, accuracy)
+        sum_requests += len(request_times)
+    if binary and not normalize:
+        urls_list = decode_urls(urls_list)
+    return urls_list, sum_requests, errors
+
+
+def _merge_batch(urls_list: Dict, url_codes: Dict, url_code_list: List[int], request_times: List[float],
+                 accuracy: float) -> None:
+    urls = list(url_codes)
+    codes = np.array(url_code_list, dtype=np.int64)
+    times = np.array(request_times, dtype=np.float64)
+    counts = np.bincount(codes, minlength=len(urls))
+    sums = np.bincount(codes, weights=times, minlength=len(urls))
+    maxes = np.zeros(len(urls))
+    np.maximum.at(maxes, codes, times)
+    positive = times > 0
+    zeros = np.bincount(codes[~positive], minlength=len(urls))
+    # Buckets of the sketches are counted for runs of equal (url code, bucket key) after sorting
+    gamma_log = QuantileSketch(accuracy).gamma_log
+    bucket_codes = codes[positive]
+    bucket_keys = np.ceil(np.log(times[positive]) / gamma_log).astype(np.int64)
+    order = np.lexsort((bucket_keys, bucket_codes))
+    bucket_codes, bucket_keys = bucket_codes[order], bucket_keys[order]
+    starts = np.flatnonzero(np.diff(bucket_codes, prepend=-1) | np.diff(bucket_keys, prepend=bucket_keys[:1] - 1))
+    bucket_counts = np.diff(np.append(starts, len(bucket_codes)))
+    part_urls = HeavyHitters(urls_list.max_urls) if isinstance(urls_list, HeavyHitters) else {}
+    for url, count, time_sum, time_max, zero_count in zip(urls, counts.tolist(), sums.tolist(), maxes.tolist(),
+                                                          zeros.tolist()):
+        stat = part_urls[url] = UrlStat(url, accuracy)
+        stat.count = stat.med.count = count
+        stat.time_sum = time_sum
+        stat.time_max = time_max
+        stat.med.zeros = zero_count
+    for code, key, count in zip(bucket_codes[starts].tolist(), bucket_keys[starts].tolist(), bucket_counts.tolist()):
+        part_urls[urls[code]].med.buckets[key] = count
+    if isinstance(part_urls, HeavyHitters):
+        for stat in part_urls.values():
+            stat.time_sum_error = .0
+        part_urls.truncate()
+    merge_url_statistics(urls_list, part_urls)
+
+
+def decode_urls(urls_list: Dict) -> Dict:
+    """
+    This function decodes urls of the statistics aggregated by bytes urls
+    :return: urls_list(dict): statistics with str urls
+    """
+    if isinstance(urls_list, HeavyHitters):
+        decoded = HeavyHitters(urls_list.max_urls)
+        decoded.floor = urls_list.floor
+        decoded.time_correction = urls_list.time_correction
+    elif isinstance(urls_list, SpillTable):
+        # Spilled statistics are decoded on spill, the table is decoded in place
+        stats = list(urls_list.values())
+        urls_list.clear()
+        decoded = urls_list
+        urls_list = {stat.url: stat for stat in stats}
+    else:
+        decoded = {}
+    for stat in urls_list.values():
+        _decode_url(stat)
+        decoded[stat.url] = stat
+    if isinstance(decoded, HeavyHitters):
+        decoded.truncate()
+    return decoded
+
+
+def _decode_url(stat: UrlStat) -> None:
+    if isinstance(stat.url, bytes):
+        stat.url = stat.url.decode('utf-8')
+    elif isinstance(stat.url, tuple):
+        stat.url = tuple(value.decode('utf-8') if isinstance(value, bytes) else value for value in stat.url)
+    else:
+        return
+    for point in (stat.series or {}).values():
+        point.url = stat.url
+
+
+def normalize_url(request: str, steps: FrozenSet[str]) -> str:
+    """
+    This function normalizes url of the request line: strips the query
+    string and replaces numeric, uuid and hex path segments by placeholders
+    depending on steps. The result is interned
+    :return: request(str): normalized request line
+    """
+    words = request.split(' ')
+    target_index = 1 if len(words) > 1 else 0
+    path, question, query = words[target_index].partition('?')
+    if 'query' in steps:
+        question = query = ''
+    segments = path.split('/')
+    for index, segment in enumerate(segments):
+        for step, (pattern, placeholder) in URL_SEGMENT_PATTERNS.items():
+            if step in steps and pattern.fullmatch(segment):
+                segments[index] = placeholder
+                break
+    words[target_index] = '/'.join(segments) + question + query
+    return sys.intern(' '.join(words))
+
+
+@lru_cache(maxsize=None)
+def url_normalizer(steps: str, cache_size: int, binary: bool = False) -> Optional[Callable]:
+    """
+    This function creates normalize_url for the comma separated steps of
+    URL_NORMALIZE memoized in LRU cache of cache_size distinct request lines.
+    In binary mode the function also decodes the request line
+    :return: normalize(function) or None if there are no steps
+    """
+    steps = frozenset(step.strip() for step in steps.split(',') if step.strip())
+    if steps - URL_NORMALIZE_STEPS:
+        LOGGER.error('Unknown URL_NORMALIZE steps {} are ignored'.format(', '.join(sorted(steps - URL_NORMALIZE_STEPS))))
+        steps &= URL_NORMALIZE_STEPS
+    if not steps:
+        return None
+    if binary:
+        return lru_cache(maxsize=cache_size)(partial(_decode_normalize_url, steps=steps))
+    return lru_cache(maxsize=cache_size)(partial(normalize_url, steps=steps))
+
+
+def _decode_normalize_url(request: bytes, steps: FrozenSet[str]) -> str:
+    return normalize_url(request.decode('utf-8'), steps)
+
+
+def time_bucketer(time_bucket: str, log_format: str, binary: bool = False) -> Optional[Callable]:
+    """
+    This function creates the function which gets the time bucket of $time_local.
+    Timestamps of the log rows repeat heavily, so the bucket start is parsed
+    once per prefix of $time_local which defines the bucket, e.g. the hour,
+    and memoized in LRU cache. TIME_BUCKET is ignored if $time_local is not
+    the variable of the log_format
+    :return: bucket(function) or None if TIME_BUCKET is not set
+    """
+    if not time_bucket:
+        return None
+    if time_bucket not in TIME_BUCKETS:
+        LOGGER.error('Unknown TIME_BUCKET {} is ignored'.format(time_bucket))
+        return None
+    if 'time_local' not in format_variables(log_format):
+        LOGGER.error('TIME_BUCKET {} is ignored, LOG_FORMAT has no $time_local'.format(time_bucket))
+        return None
+    time_format, width = TIME_BUCKETS[time_bucket]
+    bucket_start = lru_cache(maxsize=TIME_CACHE_SIZE)(partial(time_bucket_start, time_format=time_format))
+    return lambda time_local: bucket_start(time_local[:width], time_local[-TIME_ZONE_SIZE:])
+
+
+def time_bucket_start(prefix: str, zone: str, time_format: str) -> int:
+    """
+    This function parses the prefix of $time_local and its time zone
+    :return: bucket(int): unix time of the bucket start
+    """
+    if isinstance(prefix, bytes):
+        prefix, zone = prefix.decode('ascii'), zone.decode('ascii')
+    return int(datetime.strptime('{} {}'.format(prefix, zone), time_format + ' %z').timestamp())
+
+
+def format_variables(log_format: str) -> FrozenSet[str]:
+    """
+    This function gets the names of the variables of the nginx log_format
+    :return: variables(frozenset)
+    """
+    return frozenset(match.group(1) or match.group(2) for match in FORMAT_VARIABLE_PATTERN.finditer(log_format))
+
+
+def unquote_log_format(log_format: str) -> str:
+    """
+    This function joins log_format given as in nginx config, i.e. as a sequence
+    of single-quoted strings. Unquoted log_format is returned as is
+    :return: log_format(str)
+    """
+    if log_format.strip().startswith("'"):
+        return ''.join(re.findall(r"'([^']*)'", log_format))
+    return log_format
+
+
+def log_format_pattern(log_format: str, fields: Tuple[str, ...] = ROW_FIELDS, binary: bool = False) -> re.Pattern:
+    """
+    This function generates regular expression for rows in the nginx log_format.
+    Only the variables from fields are captured as named groups
+    :return: pattern(re.Pattern): compiled regular expression, for bytes in binary mode
+    """
+    log_format = unquote_log_format(log_format)
+    pattern = []
+    captured = set()
+    position = 0
+    for match in FORMAT_VARIABLE_PATTERN.finditer(log_format):
+        literal = log_format[position:match.start()]
+        pattern.append(r'\s+'.join(re.escape(word) for word in re.split(r'\s+', literal)))
+        name = match.group(1) or match.group(2)
+        quoted = log_format.count('"', 0, match.start()) % 2
+        value = r'\S*' if not quoted and name not in VARIABLE_WORDS else '.*?'
+        if name in fields and name not in captured:
+            value = '(?P<{}>{})'.format(name, value)
+            captured.add(name)
+        pattern.append(value)
+        position = match.end()
+    pattern.append(r'\s+'.join(re.escape(word) for word in re.split(r'\s+', log_format[position:])))
+    pattern = ''.join(pattern) + r'\s*$'
+    return re.compile(pattern.encode('utf-8') if binary else pattern)
+
+
+def _locate_variables(log_format: str) -> Tuple[int, Dict, Dict]:
+    """
+    This function finds variables in the row split on quotes and then on whitespace.
+    A variable is located either as a whole quoted field or as words of a field
+    :return:
+        fields_count(int): number of fields of the row split on quotes
+        locations(dict): variable -> (field, word, words, prefix, suffix), word is None for a quoted field
+        words_counts(dict): field -> number of words, None if it is unknown
+    """
+    locations = {}
+    words_counts = {}
+    fields = log_format.split('"')
+    for index, field in enumerate(fields):
+        match = FORMAT_VARIABLE_PATTERN.fullmatch(field)
+        if index % 2 and match:
+            locations.setdefault(match.group(1) or match.group(2), (index, None, 1, 0, 0))
+            continue
+        words_count = 0
+        for word in field.split():
+            variables = list(FORMAT_VARIABLE_PATTERN.finditer(word))
+            if len(variables) > 1:
+                words_count = None
+                break
+            if variables:
+                name = variables[0].group(1) or variables[0].group(2)
+                words = VARIABLE_WORDS.get(name, 1)
+                locations.setdefault(name, (index, words_count, words, variables[0].start(),
+                                            len(word) - variables[0].end()))
+                words_count += words
+            else:
+                words_count += 1
+        words_counts[index] = words_count
+    return len(fields), locations, words_counts
+
+
+@lru_cache(maxsize=None)
+def compile_log_format(log_format: str,
+                       fields: Tuple[str, ...] = ROW_FIELDS,
+                       binary: bool = False) -> Callable[[str], Optional[Tuple[str, ...]]]:
+    """
+    This function generates the extractor of fields from the row in the nginx log_format.
+    The generated code splits the row on quotes and then only the fields which
+    hold the needed variables on whitespace. Rows that can not be split as
+    the log_format are matched with the regular expression from log_format_pattern.
+    In binary mode the extractor takes and returns bytes. ValueError is raised
+    if some of the fields are not the variables of the log_format
+    :return: extract(function): row -> tuple of values of fields or None for malformed row
+    """
+    log_format = unquote_log_format(log_format)
+    missing = [name for name in fields if name not in format_variables(log_format)]
+    if missing:
+        raise ValueError('LOG_FORMAT has no {}'.format(', '.join('$' + name for name in missing)))
+    fields_count, locations, words_counts = _locate_variables(log_format)
+    code = ['def extract(row):']
+    if all(name in locations and words_counts.get(locations[name][0], 0) is not None for name in fields):
+        code += ['    fields = row.split({!r})'.format(b'"' if binary else '"'),
+                 '    if len(fields) == {}:'.format(fields_count)]
+        values = []
+        conditions = []
+        split_fields = set()
+        for name in fields:
+            index, word, words, prefix, suffix = locations[name]
+            if word is None:
+                values.append('fields[{}]'.format(index))
+                continue
+            if index not in split_fields:
+                split_fields.add(index)
+                code.append('        words{0} = fields[{0}].split()'.format(index))
+                conditions.append('len(words{}) == {}'.format(index, words_counts[index]))
+            value = 'words{}[{}]'.format(index, word) if words == 1 else \
+                '{!r}.join(words{}[{}:{}])'.format(b' ' if binary else ' ', index, word, word + words)
+            if prefix or suffix:
+                value += '[{}:{}]'.format(prefix, -suffix if suffix else '')
+            values.append(value)
+        code += ['        if {}:'.format(' and '.join(conditions) or 'True'),
+                 '            return {},'.format(', '.join(values))]
+    code += ['    match = pattern.match(row)',
+             '    return match and ({},)'.format(', '.join("match.group('{}')".format(name) for name in fields))]
+    namespace = {'pattern': log_format_pattern(log_format, fields, binary)}
+    exec('\n'.join(code), namespace)
+    return namespace['extract']
+
+
+def _aggregate_chunk(chunk: Tuple[str, int, int], file_config: Dict) -> Tuple[Dict, int, int]:
+    return aggregate_log_rows(read_log_chunk(*chunk, binary=int(file_config['BINARY'])), file_config)
+
+
+def _aggregate_block(block: bytes, file_config: Dict) -> Tuple[Dict, int, int]:
+    return aggregate_log_rows(_block_rows(block, int(file_config['BINARY'])), file_config)
+
+
+def _block_rows(block: bytes, binary: bool) -> Iterable:
+    return io.BytesIO(block) if binary else io.StringIO(block.decode('utf-8', DECODE_ERRORS), newline=None)
+
+
+@contextmanager
+def worker_pool(workers: int, ignore_interrupt: bool = False) -> Generator:
+    """
+    This context manager creates a pool of processes which is closed and joined
+    on exit. Pool.terminate may hang while tasks are being sent to the workers,
+    so the tasks left after an early stop are completed instead. Workers of a
+    pool which ignores interrupts complete their tasks on Ctrl+C
+    """
+    if ignore_interrupt:
+        pool = Pool(workers, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+    else:
+        pool = Pool(workers)
+    try:
+        yield pool
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _imap_bounded(pool: Pool, func: Callable, iterable: Iterable, limit: int) -> Generator:
+    """
+    This generator function works as Pool.imap but keeps no more than limit
+    tasks in flight, so a producer faster than the workers does not fill memory.
+    On a read error of iterable the tasks in flight are finished before it is raised
+    :return: result of func for each item in the order of iterable
+    """
+    pending = deque()
+    try:
+        for item in iterable:
+            pending.append(pool.apply_async(func, (item,)))
+            if len(pending) >= limit:
+                yield pending.popleft().get()
+    except READ_ERRORS:
+        while pending:
+            yield pending.popleft().get()
+        raise
+    while pending:
+        yield pending.popleft().get()
+
+
+def merge_url_statistics(urls_list: Dict, part_urls: Dict) -> None:
+    """
+    This function merging statistics of urls calculated for a part of log
+    into urls_list. Parts have to be merged in the order of the log rows.
+    :return:
+    """
+    if isinstance(urls_list, (HeavyHitters, SpillTable)):
+        urls_list.merge(part_urls)
+        return
+    for url, part in part_urls.items():
+        if url not in urls_list:
+            urls_list[url] = part
+        else:
+            _merge_url(urls_list[url], part)
+
+
+def _merge_url(stat: UrlStat, part: UrlStat) -> None:
+    stat.count += part.count
+    stat.med.merge(part.med)
+    stat.time_max = max(stat.time_max, part.time_max)
+    stat.time_sum += part.time_sum
+    if part.time_sum_error is not None:
+        stat.time_sum_error = (stat.time_sum_error or .0) + part.time_sum_error
+    if part.series is not None:
+        stat.series = merge_series(stat.series, part.series)
+
+
+def merge_series(series: Optional[Dict], part_series: Dict) -> Dict:
+    """
+    This function merging statistics by time buckets
+    :return: series(dict)
+    """
+    if series is None:
+        series = {}
+    for bucket, part in part_series.items():
+        if bucket in series:
+            _merge_url(series[bucket], part)
+        else:
+            series[bucket] = part
+    return series
+
+
+def split_log(file_name: str, parts: int, start: int = 0, end: Optional[int] = None) -> List[Tuple[int, int]]:
+    """
+    This function splits plain log file, or its range from the start offset
+    to the end offset, into byte ranges at line boundaries
+    :return: chunks(list): list of (start, end) offsets
+    """
+    size = os.path.getsize(file_name) if end is None else end
+    bounds = [start]
+    with open(file_name, 'rb') as log:
+        for part in range(1, parts):
+            offset = start + (size - start) * part // parts
+            if offset <= bounds[-1]:
+                continue
+            log.seek(offset - 1)
+            log.readline()
+            bounds.append(min(log.tell(), size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def read_log(file_name: str, binary: bool = False) -> Generator:
+    """
+    This generator function opening and read file. In binary mode rows
+    are not decoded and plain file is read through mmap
+    :return: row: row of file
+    """
+    if binary and not file_name.endswith('gz'):
+        with open(file_name, 'rb') as log:
+            if os.fstat(log.fileno()).st_size:
+                with mmap.mmap(log.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+                    yield from iter(log_map.readline, b'')
+        return
+    if binary:
+        log = gzip.open(file_name, mode='rb')
+    elif file_name.endswith('gz'):
+        log = gzip.open(file_name, mode='rt', encoding='utf-8', errors=DECODE_ERRORS)
+    else:
+        log = open(file_name, 'r', encoding='utf-8', errors=DECODE_ERRORS)
+    with log:
+        yield from log
+
+
+def read_log_sample(file_name: str, starts: List[int], binary: bool = False) -> Generator:
+    """
+    This generator function reads rows of plain file which begin in the
+    blocks of SAMPLE_BLOCK_SIZE bytes at the start offsets
+    :return: row: row of file, bytes in binary mode
+    """
+    with open(file_name, 'rb') as log:
+        for start in starts:
+            log.seek(max(start - 1, 0))
+            if start:
+                log.readline()
+            position = log.tell()
+            while position < start + SAMPLE_BLOCK_SIZE:
+                row = log.readline()
+                if not row:
+                    break
+                position += len(row)
+                yield row if binary else row.decode('utf-8', DECODE_ERRORS)
+
+
+def read_log_chunk(file_name: str, start: int, end: int, binary: bool = False) -> Generator:
+    """
+    This generator function reads rows of plain file starting at the start offset
+    till the row which begins at the end offset
+    :return: row: row of file, bytes in binary mode
+    """
+    with open(file_name, 'rb') as log:
+        log.seek(start)
+        position = start
+        while position < end:
+            row = log.readline()
+            if not row:
+                break
+            position += len(row)
+            yield row if binary else row.decode('utf-8', DECODE_ERRORS)
+
+
+def read_log_blocks(file_name: str, block_size: int = GZIP_BLOCK_SIZE, pigz: str = '') -> Generator:
+    """
+    This generator function reads file by blocks cut at line boundaries.
+    gzip file is decompressed by pigz -dc if pigz is given and installed
+    :return: block: bytes of whole rows
+    """
+    process = None
+    if not file_name.endswith('gz'):
+        log = open(file_name, 'rb')
+    elif pigz and shutil.which(pigz):
+        process = subprocess.Popen([pigz, '-dc', file_name], stdout=subprocess.PIPE)
+        log = process.stdout
+    else:
+        log = gzip.open(file_name, mode='rb')
+    tail = b''
+    try:
+        for block in _read_blocks(log, block_size):
+            block = tail + block
+            cut = block.rfind(b'\n') + 1
+            tail = block[cut:]
+            if cut:
+                yield block[:cut]
+    finally:
+        log.close()
+        if process:
+            process.kill()
+            process.wait()
+    if process and process.returncode not in (0, -9):
+        raise OSError('{} -dc {} is failed with code {}'.format(pigz, file_name, process.returncode))
+    if tail:
+        yield tail
+
+
+def _read_blocks(log: IO[bytes], block_size: int) -> Generator:
+    """
+    This generator function joins short reads of the file into blocks of
+    block_size bytes, so the data decompressed before a read error is
+    yielded before the error is raised
+    :return: block: bytes
+    """
+    pieces = []
+    size = 0
+    try:
+        for piece in iter(lambda: log.read1(block_size - size), b''):
+            pieces.append(piece)
+            size += len(piece)
+            if size >= block_size:
+                yield b''.join(pieces)
+                pieces, size = [], 0
+    except READ_ERRORS:
+        if pieces:
+            yield b''.join(pieces)
+        raise
+    if pieces:
+        yield b''.join(pieces)
+
+
+def read_log_pipelined(file_name: str, pigz: str = '', binary: bool = False) -> Generator:
+    """
+    This generator function reads and decompresses file by blocks in a producer
+    thread and yields rows of the blocks, so parsing of the rows overlaps
+    with decompression. Stage timings are logged when the file is done
+    :return: row: row of file, bytes in binary mode
+    """
+    blocks = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    timings = {'read': .0, 'wait': .0}
+    producer = threading.Thread(target=_produce_blocks, args=(file_name, pigz, blocks, stop, timings), daemon=True)
+    started = time.perf_counter()
+    producer.start()
+    try:
+        while True:
+            waiting = time.perf_counter()
+            block = blocks.get()
+            timings['wait'] += time.perf_counter() - waiting
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield from _block_rows(block, binary)
+    finally:
+        stop.set()
+        producer.join()
+    wall = time.perf_counter() - started
+    parse = wall - timings['wait']
+    LOGGER.info('Pipeline of {}: read {:.3f}s, parse {:.3f}s, wall {:.3f}s, overlap {:.3f}s'.format(
+        file_name, timings['read'], parse, wall, timings['read'] + parse - wall))
+
+
+def _produce_blocks(file_name: str, pigz: str, blocks: queue.Queue, stop: threading.Event, timings: Dict) -> None:
+    try:
+        reading = time.perf_counter()
+        for block in read_log_blocks(file_name, PIPELINE_BLOCK_SIZE, pigz):
+            timings['read'] += time.perf_counter() - reading
+            if not _put_block(blocks, block, stop):
+                return
+            reading = time.perf_counter()
+        _put_block(blocks, None, stop)
+    except Exception as error:
+        _put_block(blocks, error, stop)
+
+
+def _put_block(blocks: queue.Queue, block, stop: threading.Event) -> bool:
+    # The consumer may stop on a malformed row, so the producer must not wait for it forever
+    while not stop.is_set():
+        try:
+            blocks.put(block, timeout=.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def calculate_url_statistics(urls_list: Dict,
+                             url: str,
+                             rt: float,
+                             accuracy: float = DEFAULT_CONFIG['QUANTILE_ACCURACY'],
+                             bucket: Optional[int] = None) -> None:
+    """
+    This function calculating statistics for each unique url and,
+    if bucket is given, for the url in the time bucket
+    :return:
+    """
+    stat = urls_list.get(url)
+    if stat is None:
+        if isinstance(urls_list, SpillTable) and len(urls_list) >= urls_list.max_urls:
+            urls_list.spill()
+        stat = urls_list[url] = UrlStat(url, accuracy)
+        if isinstance(urls_list, HeavyHitters):
+            urls_list.replace_least(url)
+    stat.count += 1
+    stat.time_sum += rt
+    if rt > stat.time_max:
+        stat.time_max = rt
+    stat.med.add(rt)
+    if bucket is not None:
+        if stat.series is None:
+            stat.series = {}
+        point = stat.series.get(bucket)
+        if point is None:
+            point = stat.series[bucket] = UrlStat(url, accuracy)
+        point.add(rt)
+
+
+def enrich_url_statistics(urls_list: List[UrlStat],
+                          sum_req: float,
+                          sum_req_time: float,
+                          group_by: Tuple[str, ...] = ('request',)) -> List[Dict]:
+    """
+    This function enriching statistics for each unique url. Values of
+    GROUP_BY fields are the columns named as the fields, request is url
+    :return: urls_list(list): list of urls with statistics
+    """
+    report = []
+    for stat in urls_list:
+        time_sum = round(stat.time_sum, 3)
+        el = key_columns(stat.url, group_by)
+        el.update(count=stat.count, time_max=stat.time_max, time_sum=time_sum)
+        if stat.time_sum_error is not None:
+            el['time_sum_error'] = round(stat.time_sum_error, 3)
+        el['time_perc'] = round(time_sum / (sum_req_time / 100), 3)
+        el['time_avg'] = round(round(time_sum / (stat.count / 100), 3) / 100, 3)
+        el['count_perc'] = round(stat.count / (sum_req / 100), 3)
+        for name, value in zip(QUANTILES, stat.med.quantiles(QUANTILES.values())):
+            el[name] = round(value, 3)
+        if stat.series is not None:
+            el['series'] = series_statistics(stat.series)
+        report.append(el)
+    return report
+
+
+def key_columns(key, group_by: Tuple[str, ...]) -> Dict:
+    """
+    This function gets the columns of the key of statistics
+    :return: columns(dict): values by the names of GROUP_BY fields, url for request
+    """
+    values = key if len(group_by) > 1 else (key,)
+    return {'url' if field == 'request' else field: value for field, value in zip(group_by, values)}
+
+
+def pivot_url_statistics(partitions: Iterable[Dict], group_by: Tuple[str, ...], pivot: str) -> Tuple[Dict, Dict]:
+    """
+    This function merges statistics of the keys which differ only in the
+    value of the pivot field and counts requests by the values of the field
+    :return:
+        urls_list(dict): statistics by keys without the pivot field
+        pivot_counts(dict): numbers of requests by the values of the pivot field by keys
+    """
+    index = group_by.index(pivot)
+    urls_list = {}
+    pivot_counts = {}
+    for part in partitions:
+        for key, stat in part.items():
+            value = key[index]
+            key = key[:index] + key[index + 1:]
+            if len(key) == 1:
+                key = key[0]
+            if key not in urls_list:
+                urls_list[key] = UrlStat(key, stat.med.accuracy)
+                pivot_counts[key] = {}
+            _merge_url(urls_list[key], stat)
+            counts = pivot_counts[key]
+            counts[value] = counts.get(value, 0) + stat.count
+    return urls_list, pivot_counts
+
+
+def pivot_columns(report: List[Dict], urls_list: List[UrlStat], pivot_counts: Dict, pivot: str) -> List[Dict]:
+    """
+    This function adds the shares of requests with the PIVOT_SIZE most
+    frequent values of the pivot field to the report, the rest values are
+    summed in <pivot>_other_perc. Pivot on status also adds error_perc,
+    the share of requests with 5xx status
+    :return: report(list): report rows with <pivot>_<value>_perc columns
+    """
+    totals = {}
+    for stat in urls_list:
+        for value, count in pivot_counts[stat.url].items():
+            totals[value] = totals.get(value, 0) + count
+    values = [value for value, _ in sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:PIVOT_SIZE]]
+    for el, stat in zip(report, urls_list):
+        counts = pivot_counts[stat.url]
+        for value in values:
+            el['{}_{}_perc'.format(pivot, value)] = round(counts.get(value, 0) / stat.count * 100, 3)
+        if len(totals) > len(values):
+            other = sum(count for value, count in counts.items() if value not in values)
+            el['{}_other_perc'.format(pivot)] = round(other / stat.count * 100, 3)
+        if pivot == 'status':
+            errors = sum(count for value, count in counts.items() if value.isdigit() and int(value) >= 500)
+            el['error_perc'] = round(errors / stat.count * 100, 3)
+    return report
+
+
+def sample_url_statistics(report: List[Dict], urls_list: List[UrlStat], sum_req: int, sum_req_time: float,
+                          square_sum: float, sample_rate: float) -> List[Dict]:
+    """
+    This function scales count and time_sum of the report made by a sample
+    of rows and adds 95% confidence intervals of count_perc, time_perc and
+    med. time_perc is a ratio estimate, its variance is taken from the sums
+    of squares of request time which are estimated by the sketches
+    :return: report(list): report rows with count_perc_ci, time_perc_ci and med_ci
+    """
+    # Finite population correction
+    correction = max(1 - sample_rate, 0)
+    for el, stat in zip(report, urls_list):
+        el['count'] = round(stat.count / sample_rate)
+        el['time_sum'] = round(stat.time_sum / sample_rate, 3)
+        share = stat.count / sum_req
+        error = CONFIDENCE_Z * math.sqrt(share * (1 - share) / sum_req * correction)
+        el['count_perc_ci'] = [round(max(share - error, 0) * 100, 3), round(min(share + error, 1) * 100, 3)]
+        if sum_req_time > 0 and sum_req > 1:
+            share = stat.time_sum / sum_req_time
+            url_square_sum = stat.med.square_sum()
+            residuals = (1 - share) ** 2 * url_square_sum + share ** 2 * max(square_sum - url_square_sum, 0)
+            error = CONFIDENCE_Z * math.sqrt(residuals / (sum_req - 1) * sum_req * correction) / sum_req_time
+            el['time_perc_ci'] = [round(max(share - error, 0) * 100, 3), round(min(share + error, 1) * 100, 3)]
+        # Ranks of the bounds of the median are binomial around the half of the url requests
+        error = CONFIDENCE_Z * math.sqrt(.25 / stat.count * correction)
+        el['med_ci'] = [round(value, 3) for value in stat.med.quantiles((max(.5 - error, 0), min(.5 + error, 1)))]
+    return report
+
+
+def series_statistics(series: Dict) -> List[Dict]:
+    """
+    This function gets statistics by time buckets for the report
+    :return: series(list): statistics in the order of time
+    """
+    points = []
+    for bucket in sorted(series):
+        point = series[bucket]
+        el = {'time': datetime.fromtimestamp(bucket, timezone.utc).strftime('%Y-%m-%d %H:%M'), 'count': point.count,
+              'time_sum': round(point.time_sum, 3), 'time_avg': round(point.time_sum / point.count, 3)}
+        for name, value in zip(QUANTILES, point.med.quantiles(QUANTILES.values())):
+            el[name] = round(value, 3)
+        points.append(el)
+    return points
+
+
+def total_series(urls_list: Iterable[UrlStat]) -> Optional[Dict]:
+    """
+    This function merges statistics by time buckets of all urls
+    :return: series(dict) or None if there are no time buckets
+    """
+    series = None
+    for stat in urls_list:
+        for bucket, point in (stat.series or {}).items():
+            if series is None:
+                series = {}
+            if bucket not in series:
+                series[bucket] = UrlStat('', point.med.accuracy)
+            _merge_url(series[bucket], point)
+    return series
+
+
+def create_report(report: List[str], report_path: Path, series: Optional[List[Dict]] = None,
+                  sample_rate: float = .0, sidecar: bool = False) -> None:
+    """
+    This function create report. series is the latency over time of all urls,
+    sample_rate is the share of rows parsed for a sampled report. The report
+    is written by parts of the template and rows, so the whole page is never
+    built in memory. With sidecar, rows are written to the gzipped
+    report_path.json.gz, which the page loads after it is opened
+    :return:
+    """
+    try:
+        template = report_template(REPORT_TEMPLATE)
+    except:
+        LOGGER.error('Error while opening report.html')
+        return
+
+    sidecar_path = report_sidecar_path(report_path) if sidecar else None
+    values = {'series_json': series or [], 'sample_json': sample_rate,
+              'table_url_json': sidecar_path.name if sidecar_path else None}
+    # The report is written to a temporary file and renamed, so it is never seen half-written
+    try:
+        # Rows are written before the page, so the page never refers to missing rows
+        if sidecar_path:
+            with atomic_write(sidecar_path, 'wb') as raw, \
+                    gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=6, mtime=0) as compressed, \
+                    io.TextIOWrapper(compressed, encoding='utf-8') as f:
+                write_json_rows(f, report)
+        with atomic_write(report_path) as f:
+            for index, part in enumerate(template):
+                if index % 2 == 0:
+                    f.write(part)
+                elif part == 'table_json' and not sidecar_path:
+                    write_json_rows(f, report)
+                else:
+                    f.write(json.dumps(values.get(part)))
+    except:
+        LOGGER.error('Error while writing report.html')
+        return
+
+
+@lru_cache(maxsize=None)
+def report_template(template_path: str) -> Tuple[str, ...]:
+    """
+    This function reads the report template once and splits it by the
+    placeholders of JSON values
+    :return: parts(tuple): parts of the template with names of the placeholders at odd positions
+    """
+    with open(template_path, 'r', encoding='utf-8') as f:
+        return tuple(TEMPLATE_PLACEHOLDER_PATTERN.split(f.read()))
+
+
+def report_sidecar_path(report_path: Path) -> Path:
+    """
+    This function gets path of the rows of the report written beside it
+    :return: path(Path): report-Y.m.d.json.gz for report-Y.m.d.html
+    """
+    return report_path.with_suffix('.json.gz')
+
+
+def write_json_rows(f, rows: List[Dict]) -> None:
+    """
+    This function writes rows as a JSON array by batches of
+    JSON_BATCH_SIZE rows, the same as json.dumps
+    :return:
+    """
+    f.write('[')
+    for start in range(0, len(rows), JSON_BATCH_SIZE):
+        if start:
+            f.write(', ')
+        f.write(json.dumps(rows[start:start + JSON_BATCH_SIZE])[1:-1])
+    f.write(']')
+
+
+def top_url_statistics(urls_list: Dict, report_size: int, candidates: Iterable[UrlStat] = ()) -> List[UrlStat]:
+    """
+    This function selects report_size urls with max time_sum by a heap,
+    so millions of urls are not sorted for a report of a thousand. The urls
+    selected from other partitions of statistics may be given as candidates.
+    Urls are ordered by time_sum rounded as in the report and then by url,
+    since unrounded sums of parts merged in another order differ slightly
+    :return: urls_list(list): urls in the descending order of time_sum
+    """
+    return heapq.nlargest(report_size, chain(candidates, urls_list.values()), key=report_order)
+
+
+def report_order(stat: UrlStat) -> Tuple:
+    return round(stat.time_sum, 3), stat.url
+
+
+def build_report(aggregates: Tuple[Dict, int, float], report_path: Path, report_size: int,
+                 sample_rate: float = .0, file_config: Dict = DEFAULT_CONFIG, stages: Optional[Dict] = None) -> None:
+    """
+    This function creates report of report_size urls with max time_sum.
+    Quantiles are estimated only for the urls in the report. Aggregates
+    of a sample of rows are scaled by sample_rate. Spilled statistics are
+    merged and selected by partitions. With PIVOT, statistics are merged
+    over the values of the pivot field which become columns. Times of the
+    aggregate, enrich and render stages are added to stages if it is given
+    :return:
+    """
+    stages = {} if stages is None else stages
+    urls_list, sum_requests, sum_requests_time = aggregates
+    group_by = group_fields(file_config['GROUP_BY'], file_config['LOG_FORMAT'])
+    pivot = file_config['PIVOT']
+    pivot_counts = None
+    series = None
+    square_sums = []
+    top = []
+    with stage_timer(stages, 'aggregate'):
+        if pivot and (pivot not in group_by or len(group_by) < 2):
+            LOGGER.error('PIVOT {} is not one of several GROUP_BY fields and is ignored'.format(pivot))
+        elif pivot:
+            urls_list, pivot_counts = pivot_url_statistics(url_partitions(urls_list), group_by, pivot)
+            group_by = tuple(field for field in group_by if field != pivot)
+        for part in url_partitions(urls_list):
+            part_series = total_series(part.values())
+            if part_series:
+                series = merge_series(series, part_series)
+            if sample_rate:
+                square_sums.extend(stat.med.square_sum() for stat in part.values())
+            # Selecting report_size urls with max time_sum
+            top = top_url_statistics(part, report_size, top)
+    urls_list = top
+    # Get statistics
+    with stage_timer(stages, 'enrich'):
+        report = enrich_url_statistics(urls_list, sum_requests, sum_requests_time, group_by)
+        if pivot_counts is not None:
+            report = pivot_columns(report, urls_list, pivot_counts, pivot)
+        if sample_rate:
+            report = sample_url_statistics(report, urls_list, sum_requests, sum_requests_time,
+                                           math.fsum(square_sums), sample_rate)
+    # Create report
+    with stage_timer(stages, 'render'):
+        create_report(report, report_path, series_statistics(series) if series else None, sample_rate,
+                      bool(int(file_config['REPORT_SIDECAR'])))
+    LOGGER.info('The report {} is done'.format(report_path))
+
+
+@contextmanager
+def stage_timer(stages: Dict, name: str) -> Generator:
+    """
+    This context manager adds wall and CPU time of the block to the stage.
+    CPU time of pool workers is counted when the pool is joined in the block
+    """
+    wall, cpu = time.perf_counter(), cpu_time()
+    try:
+        yield
+    finally:
+        stage = stages.setdefault(name, {'wall': .0, 'cpu': .0})
+        stage['wall'] += time.perf_counter() - wall
+        stage['cpu'] += cpu_time() - cpu
+
+
+def cpu_time() -> float:
+    """
+    This function gets CPU time of the process and its finished children
+    :return: seconds(float)
+    """
+    if resource is None:
+        return time.process_time()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss() -> int:
+    """
+    This function gets peak RSS of the process or of the largest finished child
+    :return: peak_rss(int): bytes, 0 if it is unknown
+    """
+    if resource is None:
+        return 0
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def log_metrics(log: str, rows: int, size: int, stats: Dict, stages: Dict) -> Dict:
+    """
+    This function gets metrics of the report of the log. Rates are zero
+    if aggregates of the log are loaded from the cache
+    :return: metrics(dict): rows, bytes, rates, parse errors, stages and peak RSS
+    """
+    parse = stages.get('parse', {}).get('wall', .0)
+    metrics = dict(stats, log=log, rows=rows, bytes=size, stages=stages, peak_rss_bytes=peak_rss())
+    metrics['rows_per_sec'] = rows / parse if parse and not stats['cached'] else .0
+    metrics['bytes_per_sec'] = size / parse if parse and not stats['cached'] else .0
+    LOGGER.info('{} rows of {} are parsed in {:.3f}s, {:.0f} rows/s, {:.0f} bytes/s, {} malformed rows'.format(
+        rows, log, parse, metrics['rows_per_sec'], metrics['bytes_per_sec'], stats['parse_errors']))
+    return metrics
+
+
+def run_metrics(logs: List[Dict], stages: Dict, started: float) -> Dict:
+    """
+    This function sums metrics of the logs reported in the run
+    :return: metrics(dict): totals of the run, its stages and the metrics of the logs
+    """
+    totals = {name: dict(stages.get(name, {'wall': .0, 'cpu': .0})) for name in METRIC_STAGES}
+    for log in logs:
+        for name, stage in log['stages'].items():
+            total = totals.setdefault(name, {'wall': .0, 'cpu': .0})
+            total['wall'] += stage['wall']
+            total['cpu'] += stage['cpu']
+    parsed = [log for log in logs if not log['cached']]
+    parse = sum(log['stages']['parse']['wall'] for log in parsed)
+    rows = sum(log['rows'] for log in logs)
+    size = sum(log['bytes'] for log in logs)
+    metrics = {
+        'time': time.time(),
+        'wall': time.perf_counter() - started,
+        'stages': totals,
+        'rows': rows,
+        'bytes': size,
+        'rows_per_sec': sum(log['rows'] for log in parsed) / parse if parse else .0,
+        'bytes_per_sec': sum(log['bytes'] for log in parsed) / parse if parse else .0,
+        'parse_errors': sum(log['parse_errors'] for log in logs),
+        'truncated_logs': sum(log['truncated'] for log in logs),
+        'peak_rss_bytes': max([peak_rss()] + [log['peak_rss_bytes'] for log in logs]),
+        'logs': logs
+    }
+    LOGGER.info('The run is done in {:.3f}s: {} logs, {} rows, {} malformed rows, {} truncated logs, '
+                'peak RSS {} bytes'.format(metrics['wall'], len(logs), rows, metrics['parse_errors'],
+                                           metrics['truncated_logs'], metrics['peak_rss_bytes']))
+    return metrics
+
+
+def prometheus_metrics(metrics: Dict) -> str:
+    """
+    This function formats metrics of the run for the textfile collector of
+    the Prometheus node exporter, all of them are gauges of the last run
+    :return: text(str): metrics in the Prometheus text format
+    """
+    lines = []
+
+    def add(name, description, values):
+        name = '{}_{}'.format(METRIC_PREFIX, name)
+        lines.extend(('# HELP {} {}'.format(name, description), '# TYPE {} gauge'.format(name)))
+        for labels, value in values:
+            labels = ','.join('{}="{}"'.format(label, str(label_value).replace('\\', '\\\\').replace('"', '\\"')
+                                                  .replace('\n', '\\n'))
+                              for label, label_value in labels.items())
+            lines.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', float(value)))
+
+    add('last_run_timestamp_seconds', 'Unix time of the end of the run', [({}, metrics['time'])])
+    add('run_seconds', 'Wall time of the run', [({}, metrics['wall'])])
+    add('stage_seconds', 'Wall time of the stage', [({'stage': name}, stage['wall'])
+                                                    for name, stage in metrics['stages'].items()])
+    add('stage_cpu_seconds', 'CPU time of the stage with the workers', [({'stage': name}, stage['cpu'])
+                                                                         for name, stage in metrics['stages'].items()])
+    add('rows', 'Rows of the reported logs', [({}, metrics['rows'])])
+    add('bytes', 'Bytes of the reported logs', [({}, metrics['bytes'])])
+    add('rows_per_second', 'Parse rate of the logs which are not cached', [({}, metrics['rows_per_sec'])])
+    add('bytes_per_second', 'Parse rate of the logs which are not cached', [({}, metrics['bytes_per_sec'])])
+    add('parse_errors', 'Malformed rows of the reported logs', [({}, metrics['parse_errors'])])
+    add('truncated_logs', 'Logs which parsing was stopped on malformed rows or a read error',
+        [({}, metrics['truncated_logs'])])
+    add('peak_rss_bytes', 'Peak RSS of the process or of a worker', [({}, metrics['peak_rss_bytes'])])
+    add('logs', 'Reported logs', [({}, len(metrics['logs']))])
+    for name, key, description in (('log_rows', 'rows', 'Rows of the log'),
+                                   ('log_rows_per_second', 'rows_per_sec', 'Parse rate of the log'),
+                                   ('log_parse_errors', 'parse_errors', 'Malformed rows of the log'),
+                                   ('log_truncated', 'truncated',
+                                    'Parsing of the log was stopped on malformed rows or a read error')):
+        add(name, description, [({'log': Path(log['log']).name}, log[key]) for log in metrics['logs']])
+    return '\n'.join(lines) + '\n'
+
+
+def export_metrics(metrics: Dict, file_config: Dict) -> None:
+    """
+    This function writes metrics of the run to METRICS_JSON and to the
+    Prometheus textfile METRICS_TEXTFILE if they are set. The files are
+    written to temporary files and renamed, so they are never read half-written
+    :return:
+    """
+    for path, text in ((file_config['METRICS_JSON'], lambda: json.dumps(metrics, indent=2)),
+                       (file_config['METRICS_TEXTFILE'], lambda: prometheus_metrics(metrics))):
+        if not path:
+            continue
+        try:
+            with atomic_write(path) as f:
+                f.write(text())
+        except OSError:
+            LOGGER.error('Error while writing metrics {}'.format(path))
+
+
+def open_store(store_path: str, read_only: bool = False) -> sqlite3.Connection:
+    """
+    This function opens the SQLite store of daily aggregates. The store is
+    created in WAL mode with its tables and indexes unless it is read only
+    :return: connection(Connection)
+    """
+    if read_only:
+        connection = sqlite3.connect(Path(store_path).resolve().as_uri() + '?mode=ro', uri=True,
+                                     timeout=STORE_TIMEOUT)
+    else:
+        Path(store_path).parent.mkdir(exist_ok=True, parents=True)
+        connection = sqlite3.connect(store_path, timeout=STORE_TIMEOUT)
+    try:
+        version = connection.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, STORE_VERSION):
+            raise sqlite3.DatabaseError('Schema version of {} is {}, {} is expected'.format(
+                store_path, version, STORE_VERSION))
+        if not read_only:
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = NORMAL')
+            with connection:
+                for statement in STORE_SCHEMA:
+                    connection.execute(statement)
+                connection.execute('PRAGMA user_version = {}'.format(STORE_VERSION))
+    except sqlite3.Error:
+        connection.close()
+        raise
+    return connection
+
+
+def store_url_statistics(urls_list: Dict, group_by: Tuple[str, ...]) -> Iterable[UrlStat]:
+    """
+    This function gets the statistics of urls to store. With several
+    GROUP_BY fields statistics are merged over the values of other fields
+    :return: urls_list(iterable): statistics with str urls
+    """
+    if group_by == ('request',):
+        return chain.from_iterable(part.values() for part in url_partitions(urls_list))
+    index = group_by.index('request')
+    requests = {}
+    for part in url_partitions(urls_list):
+        for key, stat in part.items():
+            url = key[index]
+            if url not in requests:
+                requests[url] = UrlStat(url, stat.med.accuracy)
+            _merge_url(requests[url], stat)
+    return requests.values()
+
+
+def store_aggregates(aggregates: Tuple[Dict, int, float], day: date, log: str, file_config: Dict) -> None:
+    """
+    This function replaces the statistics of the day in STORE_DB by the
+    aggregates of the log: count, time_sum, time_max and the serialized
+    quantile sketch of each url. Rows are inserted by executemany in one
+    transaction, so readers see the previous or the new day entirely
+    :return:
+    """
+    store_path = file_config['STORE_DB']
+    group_by = group_fields(file_config['GROUP_BY'], file_config['LOG_FORMAT'])
+    if 'request' not in group_by:
+        LOGGER.error('GROUP_BY {} has no request field, {} is not stored'.format(file_config['GROUP_BY'], log))
+        return
+    urls_list, sum_requests, sum_requests_time = aggregates
+    day = day.isoformat()
+    rows = ((stat.url, day, stat.count, stat.time_sum, stat.time_max, stat.med.to_bytes())
+            for stat in store_url_statistics(urls_list, group_by))
+    try:
+        with closing(open_store(store_path)) as connection, connection:
+            connection.execute('DELETE FROM url_stats WHERE day = ?', (day,))
+            connection.execute('INSERT OR REPLACE INTO days (day, log, requests, time_sum, accuracy) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               (day, str(log), sum_requests, sum_requests_time,
+                                float(file_config['QUANTILE_ACCURACY'])))
+            connection.executemany('INSERT INTO url_stats (url, day, count, time_sum, time_max, sketch) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)', rows)
+    except sqlite3.Error as error:
+        LOGGER.error('Error while storing {} to {}: {}'.format(log, store_path, error))
+        return
+    LOGGER.info('Statistics of {} for {} are stored to {}'.format(log, day, store_path))
+
+
+def log_date(file: Path) -> date:
+    """
+    This function gets date of the log from its name
+    :return: date
+    """
+    log_name_date = DATE_PATTERN.search(file.name).groupdict()
+    return date(int(log_name_date['Y']), int(log_name_date['m']), int(log_name_date['d']))
+
+
+def rollup(file_config: Dict, stages: Optional[Dict] = None) -> List[Dict]:
+    """
+    This function creates one report for the logs of the last ROLLUP days
+    counted back from the date of the last log
+    :return: metrics(list): metrics of the report as of one log, empty if it is not built
+    """
+    stages = {} if stages is None else stages
+    logs_dir = file_config['LOG_DIR']
+    match = ROLLUP_PATTERN.fullmatch(file_config['ROLLUP'])
+    if not match:
+        LOGGER.error('Rollup period {} is wrong, it has to be like 7d'.format(file_config['ROLLUP']))
+        return []
+    days = int(match.group('days'))
+    with stage_timer(stages, 'discovery'):
+        logs = find_logs(logs_dir, LOG_PREFIX + '*', days, file_config)
+    if not logs:
+        LOGGER.info('Log file or dir {} is not founded!'.format(logs_dir))
+        return []
+    last_date = logs[0][0]
+    first_date = last_date - timedelta(days=days - 1)
+    files = [file for day, file in logs if day >= first_date]
+    report_path = Path(file_config['REPORT_DIR']) / 'report-{:%Y.%m.%d}-{:%Y.%m.%d}.html'.format(first_date, last_date)
+    report_path.parent.mkdir(exist_ok=True, parents=True)
+    if report_path.exists():
+        LOGGER.info('Report {} is completed early!'.format(report_path))
+        return []
+    log_stages = {}
+    stats = {}
+    with stage_timer(log_stages, 'parse'):
+        aggregates = rollup_logs([str(file) for file in reversed(files)], file_config, stats)
+    if stats['read_error']:
+        LOGGER.error('Report {} is not built, some logs are not read completely'.format(report_path))
+    else:
+        build_report(aggregates, report_path, int(file_config['REPORT_SIZE']), file_config=file_config,
+                     stages=log_stages)
+    return [log_metrics(str(report_path), aggregates[1], sum(log_size(str(file)) for file in files), stats,
+                        log_stages)]
+
+
+def log_report_path(file: Path, file_config: Dict, day: Optional[date] = None) -> Path:
+    """
+    This function gets path of the report of the log, the date of the log
+    is parsed from its name if it is not given
+    :return: report_path(Path)
+    """
+    report_name = 'report-{:%Y.%m.%d}.html'.format(day or log_date(file))
+    if float(file_config['SAMPLE']):
+        report_name = report_name.replace('.html', '.sample.html')
+    return Path(file_config['REPORT_DIR']) / report_name
+
+
+def needs_report(file: Path, report_path: Path, file_config: Dict) -> bool:
+    """
+    This function checks that the report of the log has to be built:
+    it does not exist, the log is growing and parsed incrementally or the
+    report is a sampled preview
+    :return: bool
+    """
+    return not report_path.exists() or bool(int(file_config['INCREMENTAL']) and file.suffix == '.plain') or \
+        bool(float(file_config['SAMPLE']))
+
+
+def report_log(file: str, report_path: Path, file_config: Dict) -> Dict:
+    """
+    This function parses the log, or its sample if SAMPLE is set, and builds its report
+    :return: metrics(dict): metrics of the report of the log
+    """
+    report_path.parent.mkdir(exist_ok=True, parents=True)
+    stages = {}
+    stats = {}
+    sample_rate = float(file_config['SAMPLE'])
+    with stage_timer(stages, 'parse'):
+        if sample_rate:
+            aggregates, sample_rate = sample_log(file, file_config, stats)
+        else:
+            aggregates = parse_log(file, file_config, stats)
+    if stats['read_error']:
+        LOGGER.error('Report {} is not built, {} is not read completely'.format(report_path, file))
+    else:
+        build_report(aggregates, report_path, int(file_config['REPORT_SIZE']), sample_rate, file_config, stages)
+    if file_config['STORE_DB'] and not sample_rate and not stats['read_error']:
+        with stage_timer(stages, 'store'):
+            store_aggregates(aggregates, log_date(Path(file)), file, file_config)
+    size = log_size(file)
+    return log_metrics(file, aggregates[1], round(size * sample_rate) if sample_rate else size, stats, stages)
+
+
+def report_logs(logs: List[Tuple[Path, Path]], file_config: Dict) -> List[Dict]:
+    """
+    This function reports the logs one after another or, if PARALLEL_LOGS
+    is more than one, by a pool of PARALLEL_LOGS processes, one log per
+    process, each log is parsed with WORKERS=1. The largest logs are
+    started first. While other logs are in progress, the largest queued
+    log is started whose size keeps the total size of the logs in progress
+    within PARALLEL_LOGS_BYTES. On Ctrl+C the started reports are completed
+    :return: metrics(list): metrics of the reported logs in the order of logs
+    """
+    parallel = min(int(file_config['PARALLEL_LOGS']), len(logs))
+    if parallel <= 1:
+        return [report_log(str(file), report_path, file_config) for file, report_path in logs]
+    max_bytes = int(file_config['PARALLEL_LOGS_BYTES'])
+    queued = sorted(((file, report_path, log_size(str(file))) for file, report_path in logs),
+                    key=lambda log: log[2], reverse=True)
+    finished = queue.Queue()
+    pending = {}
+    metrics = {}
+    with worker_pool(parallel, ignore_interrupt=True) as pool:
+        try:
+            while queued or pending:
+                while queued and len(pending) < parallel:
+                    in_progress = sum(pending.values())
+                    index = next((index for index, (_, _, size) in enumerate(queued)
+                                  if not pending or not max_bytes or in_progress + size <= max_bytes), None)
+                    if index is None:
+                        break
+                    file, report_path, size = queued.pop(index)
+                    pending[file] = size
+                    pool.apply_async(report_log, (str(file), report_path, dict(file_config, WORKERS=1)),
+                                     callback=lambda result, file=file: finished.put((file, result)),
+                                     error_callback=lambda error, file=file: finished.put((file, error)))
+                file, result = finished.get()
+                del pending[file]
+                _record_result(metrics, file, result)
+        except KeyboardInterrupt:
+            LOGGER.info('Reporting is stopped, {} started reports are completed'.format(len(pending)))
+    # Results of the reports completed after Ctrl+C are delivered when the pool is joined
+    while not finished.empty():
+        _record_result(metrics, *finished.get())
+    return [metrics[file] for file, _ in logs if file in metrics]
+
+
+def _record_result(metrics: Dict, file: Path, result) -> None:
+    if isinstance(result, BaseException):
+        LOGGER.error('Error while reporting {}: {}'.format(file, result))
+    else:
+        metrics[file] = result
+
+
+def log_size(file: str) -> int:
+    """
+    This function gets size of the log
+    :return: size(int): bytes, 0 if the log is not available
+    """
+    try:
+        return os.path.getsize(file)
+    except OSError:
+        return 0
+
+
+def scan_logs(logs_dir: str, file_config: Dict) -> Dict[str, Tuple[int, int]]:
+    """
+    This function gets the newest LOGS_COUNT nginx logs of the dir from its
+    index, so logs without a date in the name are skipped and old logs
+    are not checked
+    :return: logs(dict): size and modification time of the logs by their paths
+    """
+    logs = {}
+    for _, name in heapq.nlargest(int(file_config['LOGS_COUNT']), log_index(logs_dir, LOG_PREFIX + '*', file_config)):
+        path = os.path.join(logs_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        logs[path] = (stat.st_size, stat.st_mtime_ns)
+    return logs
+
+
+def watch(file_config: Dict, polls: Optional[int] = None) -> None:
+    """
+    This function keeps running and polls LOG_DIR every WATCH_INTERVAL seconds.
+    Only the newest LOGS_COUNT logs with a date in the name are checked, so
+    the first poll of a dir with years of logs does not report all of them.
+    A log is reported when its size and modification time are the same
+    in two polls, so logs which are still being written are not parsed.
+    Logs are parsed by a pool of WORKERS processes, one log per process.
+    Logs which are reported or whose reports exist are remembered and
+    not checked again until they change. Metrics are exported after each
+    poll in which logs are reported
+    :return:
+    """
+    logs_dir = file_config['LOG_DIR']
+    interval = float(file_config['WATCH_INTERVAL'])
+    workers = int(file_config['WORKERS'])
+    seen = {}
+    previous = {}
+    pending = {}
+    LOGGER.info('Watching {} every {} seconds'.format(logs_dir, interval))
+    with worker_pool(workers, ignore_interrupt=True) if workers > 1 else nullcontext() as pool:
+        try:
+            while polls is None or polls > 0:
+                started = time.perf_counter()
+                stages = {}
+                reported = []
+                try:
+                    with stage_timer(stages, 'discovery'):
+                        logs = scan_logs(logs_dir, file_config)
+                except OSError:
+                    LOGGER.error('Error while scanning {}'.format(logs_dir))
+                    logs = {}
+                for path, signature in sorted(logs.items(), reverse=True):
+                    if path in pending or seen.get(path) == signature or previous.get(path) != signature:
+                        continue
+                    report_path = log_report_path(Path(path), file_config)
+                    if not needs_report(Path(path), report_path, file_config):
+                        seen[path] = signature
+                    elif pool:
+                        pending[path] = signature, pool.apply_async(report_log, (path, report_path,
+                                                                                 dict(file_config, WORKERS=1)))
+                    else:
+                        reported.append(report_log(path, report_path, file_config))
+                        seen[path] = signature
+                for path, (signature, result) in list(pending.items()):
+                    if result.ready():
+                        del pending[path]
+                        try:
+                            reported.append(result.get())
+                            seen[path] = signature
+                        except Exception:
+                            LOGGER.exception('Error while reporting {}'.format(path))
+                if reported:
+                    export_metrics(run_metrics(reported, stages, started), file_config)
+                previous = logs
+                if polls is not None:
+                    polls -= 1
+                if polls != 0:
+                    time.sleep(interval)
+        except KeyboardInterrupt:
+            LOGGER.info('Watching {} is stopped'.format(logs_dir))
+
+
+def main(file_config: Dict) -> None:
+    """
+    This function processes logs
+    :return:
+    """
+    if file_config['ENGINE'] == 'numpy' and np is None:
+        LOGGER.error('numpy is not installed, logs are parsed by the python engine')
+    missing = [name for name in ROW_FIELDS if name not in format_variables(file_config['LOG_FORMAT'])]
+    if missing:
+        LOGGER.error('LOG_FORMAT has no {}, logs are not parsed'.format(', '.join('$' + name for name in missing)))
+        return
+    started = time.perf_counter()
+    stages = {}
+    if file_config['ROLLUP']:
+        export_metrics(run_metrics(rollup(file_config, stages), stages, started), file_config)
+        return
+    if int(file_config['WATCH']):
+        watch(file_config)
+        return
+    # Initiating configuration parameters
+    logs_dir = file_config['LOG_DIR']
+    log_template = LOG_PREFIX + '*'
+    # Get last log file
+    with stage_timer(stages, 'discovery'):
+        files = find_logs(logs_dir, log_template, int(file_config['LOGS_COUNT']), file_config)
+    logs = []
+    # Parsing log files
+    if len(files) > 0:
+        for day, file in files:
             # Set report name and dir
-            report_name = report_template.format(**DATE_PATTERN.search(file.name).groupdict())
-            report_path = reports_dir / report_name
-            report_path.parent.mkdir(exist_ok=True, parents=True)
-            # If report already exists then exit with msg
-            if Path(report_path).exists():
+            report_path = log_report_path(file, file_config, day)
+            # If report already exists then exit with msg, reports of growing logs are refreshed in incremental mode
+            if not needs_report(file, report_path, file_config):
                 LOGGER.info('Report {} is completed early!'.format(report_path))
             else:
-                urls_list, sum_requests, sum_requests_time = parse_log(str(file))
-                # Sorting urls list on max time_sum for max report_size
-                urls_list = sorted(urls_list.values(), key=lambda el: el.get('time_sum', 0), reverse=True)[
-                            :int(report_size)]
-                # Get statistics
-                urls_list = enrich_url_statistics(urls_list, sum_requests, sum_requests_time)
-                # Create report
-                create_report(urls_list, report_path)
-                LOGGER.info('The report {} is done'.format(report_path))
+                logs.append((file, report_path))
     else:
         LOGGER.info('Log file or dir {} is not founded!'.format(logs_dir))
+    reported = report_logs(logs, file_config)
+    export_metrics(run_metrics(reported, stages, started), file_config)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import sqlite3
+import sys
+from contextlib import closing
+from datetime import date, timedelta
+from typing import Dict, List, Optional
+
+from log_analyzer import QUANTILES, QuantileSketch, UrlStat, enrich_url_statistics, open_store
+
+# Columns of the printed statistics
+COLUMNS = ('count', 'count_perc', 'time_sum', 'time_perc', 'time_avg', 'time_max') + tuple(QUANTILES)
+# Orders of top urls and their SQL expressions
+TOP_ORDERS = {'time_sum': 'SUM(time_sum)', 'count': 'SUM(count)', 'time_max': 'MAX(time_max)'}
+
+
+def parse_args(args: Optional[List[str]] = None) -> argparse.Namespace:
+    """
+    This function creates args of the query of the store
+    :return: args(Namespace): parsed args
+    """
+    parser = argparse.ArgumentParser(description='Queries of the daily aggregates stored by log_analyzer')
+    parser.add_argument('--db', required=True, help='path to STORE_DB')
+    parser.add_argument('--days', type=int, default=7, help='number of days up to the last day')
+    parser.add_argument('--last', type=date.fromisoformat,
+                        help='last day as YYYY-MM-DD, the last stored day by default')
+    parser.add_argument('--json', action='store_true', help='print rows as JSON')
+    commands = parser.add_subparsers(dest='command', required=True)
+    trend = commands.add_parser('trend', help='statistics of the url by days')
+    trend.add_argument('url')
+    top = commands.add_parser('top', help='top urls of the days')
+    top.add_argument('--limit', type=int, default=10, help='number of urls')
+    top.add_argument('--order', choices=sorted(TOP_ORDERS), default='time_sum', help='order of urls')
+    return parser.parse_args(args)
+
+
+def stored_stat(url: str, count: int, time_sum: float, time_max: float, med: QuantileSketch) -> UrlStat:
+    """
+    This function restores statistics of the url from the stored values
+    :return: stat(UrlStat)
+    """
+    stat = UrlStat(url, med.accuracy)
+    stat.count = count
+    stat.time_sum = time_sum
+    stat.time_max = time_max
+    stat.med = med
+    return stat
+
+
+def last_day(connection: sqlite3.Connection) -> Optional[date]:
+    """
+    This function gets the last stored day
+    :return: day(date): None if the store is empty
+    """
+    day = connection.execute('SELECT MAX(day) FROM days').fetchone()[0]
+    return date.fromisoformat(day) if day else None
+
+
+def url_trend(connection: sqlite3.Connection, url: str, first: date, last: date) -> List[Dict]:
+    """
+    This function gets statistics of the url for each stored day from
+    first to last, shares are of the requests of the day
+    :return: report(list): statistics of the url with the day
+    """
+    rows = connection.execute(
+        'SELECT s.day, s.count, s.time_sum, s.time_max, s.sketch, d.requests, d.time_sum '
+        'FROM url_stats AS s JOIN days AS d ON d.day = s.day '
+        'WHERE s.url = ? AND s.day BETWEEN ? AND ? ORDER BY s.day',
+        (url, first.isoformat(), last.isoformat()))
+    report = []
+    for day, count, time_sum, time_max, sketch, sum_requests, sum_requests_time in rows:
+        stat = stored_stat(url, count, time_sum, time_max, QuantileSketch.from_bytes(sketch))
+        report.append(dict(day=day, **enrich_url_statistics([stat], sum_requests, sum_requests_time)[0]))
+    return report
+
+
+def top_urls(connection: sqlite3.Connection, first: date, last: date, limit: int = 10,
+             order: str = 'time_sum') -> List[Dict]:
+    """
+    This function gets limit urls with the largest sum of time_sum, count
+    or with the largest time_max over the days from first to last. Sums
+    are selected by the index of days, then sketches of the selected urls
+    are merged, shares are of the requests of the days
+    :return: report(list): statistics of the urls
+    """
+    first, last = first.isoformat(), last.isoformat()
+    sum_requests, sum_requests_time = connection.execute(
+        'SELECT SUM(requests), SUM(time_sum) FROM days WHERE day BETWEEN ? AND ?', (first, last)).fetchone()
+    top = connection.execute(
+        'SELECT url, SUM(count), SUM(time_sum), MAX(time_max) FROM url_stats WHERE day BETWEEN ? AND ? '
+        'GROUP BY url ORDER BY {} DESC LIMIT ?'.format(TOP_ORDERS[order]), (first, last, limit)).fetchall()
+    urls_list = []
+    for url, count, time_sum, time_max in top:
+        med = None
+        for sketch, in connection.execute('SELECT sketch FROM url_stats WHERE url = ? AND day BETWEEN ? AND ?',
+                                          (url, first, last)):
+            if med is None:
+                med = QuantileSketch.from_bytes(sketch)
+            else:
+                med.merge(QuantileSketch.from_bytes(sketch))
+        urls_list.append(stored_stat(url, count, time_sum, time_max, med))
+    return enrich_url_statistics(urls_list, sum_requests, sum_requests_time)
+
+
+def format_rows(report: List[Dict], key: str) -> str:
+    """
+    This function formats statistics as a table separated by tabs
+    :return: text(str)
+    """
+    lines = ['\t'.join((key,) + COLUMNS)]
+    lines.extend('\t'.join(str(el[column]) for column in (key,) + COLUMNS) for el in report)
+    return '\n'.join(lines) + '\n'
+
+
+def main(args: argparse.Namespace) -> List[Dict]:
+    """
+    This function runs the query of the store and prints its rows
+    :return: report(list): rows of the query
+    """
+    with closing(open_store(args.db, read_only=True)) as connection:
+        last = args.last or last_day(connection)
+        if last is None:
+            report = []
+        else:
+            first = last - timedelta(days=args.days - 1)
+            if args.command == 'trend':
+                report = url_trend(connection, args.url, first, last)
+            else:
+                report = top_urls(connection, first, last, args.limit, args.order)
+    if args.json:
+        sys.stdout.write(json.dumps(report) + '\n')
+    else:
+        sys.stdout.write(format_rows(report, 'day' if args.command == 'trend' else 'url'))
+    return report
+
+
+if __name__ == '__main__':
+    try:
+        main(parse_args())
+    except (sqlite3.Error, ValueError) as error:
+        sys.stderr.write('Query is failed: {}\n'.format(error))
+        sys.exit(1)
@@ -1,8 +1,71 @@
+import gzip
+import io
+import math
+import os
+import pickle
+import random
+import sqlite3
+import tempfile
+import time
 import unittest
 import json
+from contextlib import closing, nullcontext
+from datetime import date
+from pathlib import Path
 from unittest.mock import patch
 
-from log_analyzer import log_finder, get_urls_stat
+from benchmark import compare_results, generate_log, generate_logs, main as benchmark_main, parse_args
+from log_store import main as store_main, parse_args as store_args, top_urls, url_trend
+from log_analyzer import (
+    DEFAULT_CONFIG, TIME_BUCKETS, UI_SHORT_FORMAT, QuantileSketch, UrlStat, aggregate_log_rows, build_report,
+    calculate_url_statistics, create_report,
+    aggregates_cache_path, compile_log_format, enrich_url_statistics, find_logs, group_fields, log_format_pattern,
+    log_report_path, main, merge_url_statistics, np, open_store, parse_log, prometheus_metrics, read_log_chunk, report_log,
+    report_logs, rollup_logs, run_metrics, sample_log, sample_url_statistics, series_statistics, time_bucket_start,
+    store_aggregates, top_url_statistics, total_request_time, total_series, url_normalizer, url_partitions, valid_sample,
+    watch
+)
+
+TEST_CONFIG = dict(DEFAULT_CONFIG, CACHE_DIR='')
+LOG_ROWS = [
+    '1.196.116.32 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" '
+    '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-2190034393-4708-9752759" '
+    '"dc7161be3" 0.390\n',
+    '1.99.174.176 3b81f63526fa8  - [29/Jun/2017:03:50:22 +0300] "GET /api/1/photogenic_banners/list/?server_name=WIN7RB4 '
+    'HTTP/1.1" 200 12 "-" "Python-urllib/2.7" "-" "1498697422-32900793-4708-9752770" "-" 0.133\n',
+    '1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/16852664 HTTP/1.1" 200 19415 "-" '
+    '"Slotovod" "-" "1498697422-2118016444-4708-9752769" "712e90144abee9" 0.199\n',
+    '1.199.4.96 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/slot/4705/groups HTTP/1.1" 200 2613 "-" '
+    '"Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5" "-" "1498697422-3800516057-4708-9752745" '
+    '"2a828197ae235b0b3cb" 0.704\n',
+    '1.168.65.96 -  - [29/Jun/2017:03:50:22 +0300] "GET /api/v2/banner/25019354 HTTP/1.1" 200 927 "-" '
+    '"Mozilla "quoted" agent" "-" "1498697422-2760328665-4708-9752787" "-" 0.146\n',
+]
+
+
+def report_rows(aggregates):
+    # time_sum is summed unrounded, so parts merged in a different order are equal up to the report rounding
+    urls_list, sum_requests, sum_requests_time = aggregates
+    return enrich_url_statistics(sorted(urls_list.values(), key=lambda stat: stat.url), sum_requests, sum_requests_time)
+
+
+def report_html(aggregates, report_dir, report_size=1000):
+    report_path = Path(report_dir) / 'report.html'
+    build_report(aggregates, report_path, report_size)
+    return report_path.read_text()
+
+
+def tied_rows(rows):
+    # Many urls with equal rounded sums of request time which differ unrounded when summed in another order
+    rnd = random.Random(5)
+    return [row.replace('25019354', str(rnd.randint(1, 300))).replace('0.390', rnd.choice(('0.100', '0.200', '0.300')))
+            for row in rows]
+
+
+def banner_row(banner, request_time):
+    # The first of LOG_ROWS with the url of the banner and the request time
+    return LOG_ROWS[0].replace('/api/v2/banner/25019354', '/api/v2/banner/{}'.format(banner)).replace(
+        '0.390', '{:.3f}'.format(request_time))
 
 
 class TestLogAnalyzer(unittest.TestCase):
@@ -369,16 +432,877 @@ class TestLogAnalyzer(unittest.TestCase):
                    "time_sum": 1328.435, "time_perc": 0.488, "time_avg": 10.8, "count_perc": 0.029},
                   {"url": "GET /api/v2/internal/slots HTTP/1.1", "med": 24.342, "count": 41, "time_max": 26.455,
                    "time_sum": 940.089, "time_perc": 0.345, "time_avg": 22.929, "count_perc": 0.01}]
-        p_string = get_urls_stat(logs, 431421, 272307.06399974105)
-        self.assertAlmostEqual(json.dumps(string), p_string)
+        urls_list = []
+        for el in logs:
+            stat = UrlStat(el['url'])
+            stat.count, stat.time_sum, stat.time_max = el['count'], el['time_sum'], el['time_max']
+            for value in el['med']:
+                stat.med.add(value)
+            urls_list.append(stat)
+        report = enrich_url_statistics(urls_list, 431421, 272307.06399974105)
+        for el, expected in zip(report, string):
+            med = el.pop('med')
+            self.assertEqual({key: el[key] for key in expected if key != 'med'},
+                             {key: value for key, value in expected.items() if key != 'med'})
+            # The median is estimated by the sketch within QUANTILE_ACCURACY
+            self.assertAlmostEqual(med, expected['med'], delta=expected['med'] * TEST_CONFIG['QUANTILE_ACCURACY'])
 
     def test_log_finder(self):
-        file_names = [
-            '.\\nginx-access-ui.log-20170627.gz', '.\\nginx-access-ui.log-20170628.gz',
-            '.\\nginx-access-ui.log-20170629.gz', '.\\nginx-access-ui.log-20170630.gz',
-        ]
-        with patch('glob.glob', lambda dir_path: file_names):
-            self.assertEqual(
-                log_finder('./', 'nginx-access-ui*'),
-                '.\\nginx-access-ui.log-20170630.gz'
-            )
+        with tempfile.TemporaryDirectory() as log_dir:
+            for day in range(27, 31):
+                Path(log_dir, 'nginx-access-ui.log-201706{}.gz'.format(day)).touch()
+            self.assertEqual(find_logs(log_dir, 'nginx-access-ui*', 1, TEST_CONFIG),
+                             [(date(2017, 6, 30), Path(log_dir, 'nginx-access-ui.log-20170630.gz'))])
+
+
+class TestParseLog(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        self.rows = [row for _ in range(500) for row in LOG_ROWS]
+
+    def tearDown(self):
+        self.log_dir.cleanup()
+
+    def write_log(self, name, rows):
+        path = os.path.join(self.log_dir.name, name)
+        with (gzip.open(path, 'wt', encoding='utf-8') if name.endswith('gz') else open(path, 'w')) as log:
+            log.writelines(rows)
+        return path
+
+    def test_parallel_parse_is_equal_to_single_process(self):
+        for name in ('nginx-access-ui.log-20170630.plain', 'nginx-access-ui.log-20170630.gz'):
+            path = self.write_log(name, tied_rows(self.rows))
+            for report_size in (1000, 100):
+                self.assertEqual(report_html(parse_log(path, TEST_CONFIG), self.log_dir.name, report_size),
+                                 report_html(parse_log(path, dict(TEST_CONFIG, WORKERS=3)), self.log_dir.name,
+                                             report_size))
+
+    def test_pipelined_parse_is_equal_to_single_process(self):
+        for name in ('nginx-access-ui.log-20170630.plain', 'nginx-access-ui.log-20170630.gz'):
+            path = self.write_log(name, self.rows)
+            self.assertEqual(parse_log(path, TEST_CONFIG), parse_log(path, dict(TEST_CONFIG, PIPELINE=1)))
+        path = self.write_log('nginx-access-ui.log-20170629.plain', self.rows[:1000] + ['garbage\n'] + self.rows)
+        self.assertEqual(parse_log(path, dict(TEST_CONFIG, PIPELINE=1))[1], 1000)
+
+    def test_binary_parse_is_equal_to_text(self):
+        for name in ('nginx-access-ui.log-20170630.plain', 'nginx-access-ui.log-20170630.gz'):
+            path = self.write_log(name, self.rows)
+            aggregates = parse_log(path, TEST_CONFIG)
+            for params in ({}, {'WORKERS': 3}, {'PIPELINE': 1}, {'URL_NORMALIZE': 'id'}, {'MAX_URLS': 2}):
+                self.assertEqual(parse_log(path, dict(TEST_CONFIG, BINARY=1, **params)),
+                                 parse_log(path, dict(TEST_CONFIG, **params)) if params else aggregates)
+
+    @unittest.skipIf(np is None, 'numpy is not installed')
+    def test_numpy_engine_is_equal_to_python(self):
+        rnd = random.Random(3)
+        rows = [row.replace('0.390', '{:.3f}'.format(rnd.choice((0, rnd.random())))) for row in self.rows]
+        rows = rows[:1000] + ['garbage\n'] + rows
+        for name in ('nginx-access-ui.log-20170630.plain', 'nginx-access-ui.log-20170630.gz'):
+            path = self.write_log(name, rows)
+            for params in ({}, {'WORKERS': 3}, {'BINARY': 1}, {'URL_NORMALIZE': 'id'}):
+                self.assertEqual(parse_log(path, dict(TEST_CONFIG, ENGINE='numpy', **params)),
+                                 parse_log(path, dict(TEST_CONFIG, **params)))
+        with patch('log_analyzer.NUMPY_BATCH_SIZE', 7):
+            urls_list, sum_requests, _ = parse_log(path, dict(TEST_CONFIG, ENGINE='numpy', MAX_URLS=2))
+        self.assertEqual(sum_requests, 1000)
+        self.assertLessEqual(len(urls_list), 2)
+
+    def test_non_finite_request_times_are_malformed(self):
+        rows = [LOG_ROWS[0].replace('0.390', value) for value in ('inf', '1e400', 'nan', '-inf')] + self.rows
+        for engine in ('python', 'numpy') if np is not None else ('python',):
+            file_config = dict(TEST_CONFIG, ENGINE=engine, MAX_PARSE_ERRORS=4)
+            urls_list, sum_requests, errors = aggregate_log_rows(rows, file_config)
+            self.assertEqual((sum_requests, errors), (len(self.rows), 4))
+            self.assertEqual(report_rows((urls_list, sum_requests, total_request_time(urls_list))),
+                             report_rows(parse_log(self.write_log('nginx-access-ui.log-20170630.plain', self.rows),
+                                                   TEST_CONFIG)))
+
+    def test_top_url_statistics(self):
+        rnd = random.Random(4)
+        rows = [row.replace('25019354', str(rnd.randint(1, 300))).replace('0.390', '{:.3f}'.format(rnd.random()))
+                for row in self.rows]
+        for rows in (rows, tied_rows(self.rows)):
+            urls_list, _, _ = aggregate_log_rows(rows)
+            ordered = sorted(urls_list.values(), key=lambda el: (round(el.time_sum, 3), el.url), reverse=True)
+            for report_size in (0, 10, len(urls_list) + 1):
+                self.assertEqual(top_url_statistics(urls_list, report_size), ordered[:report_size])
+
+    def test_parallel_parse_stops_on_malformed_row(self):
+        rows = tied_rows(self.rows)
+        path = self.write_log('nginx-access-ui.log-20170630.plain', rows[:1000] + ['garbage\n'] + rows)
+        urls_list, sum_requests, _ = parse_log(path, dict(TEST_CONFIG, WORKERS=3))
+        self.assertEqual(sum_requests, 1000)
+        self.assertEqual(report_html(parse_log(path, TEST_CONFIG), self.log_dir.name),
+                         report_html((urls_list, sum_requests, _), self.log_dir.name))
+
+    def test_malformed_rows_are_skipped(self):
+        rows = self.rows[:1000] + ['garbage\n'] * 3 + self.rows
+        path = self.write_log('nginx-access-ui.log-20170630.plain', rows)
+        for workers in (1, 3):
+            stats = {}
+            aggregates = parse_log(path, dict(TEST_CONFIG, WORKERS=workers, MAX_PARSE_ERRORS=3), stats)
+            self.assertEqual(aggregates[1], len(rows) - 3)
+            self.assertEqual(stats, {'parse_errors': 3, 'truncated': False, 'read_error': False, 'cached': False})
+            stats = {}
+            self.assertEqual(parse_log(path, dict(TEST_CONFIG, WORKERS=workers, MAX_PARSE_ERRORS=2), stats)[1], 1000)
+            self.assertEqual(stats, {'parse_errors': 3, 'truncated': True, 'read_error': False, 'cached': False})
+        # Aggregates of a log with malformed rows are not cached, so the errors are reported by each run
+        file_config = dict(TEST_CONFIG, CACHE_DIR=os.path.join(self.log_dir.name, 'cache'), MAX_PARSE_ERRORS=3)
+        parse_log(path, file_config)
+        self.assertFalse(aggregates_cache_path(path, file_config).exists())
+
+    def test_undecodable_rows_are_malformed(self):
+        path = os.path.join(self.log_dir.name, 'nginx-access-ui.log-20170630.plain')
+        with open(path, 'wb') as log:
+            log.write(''.join(self.rows[:1000]).encode() + LOG_ROWS[0].encode().replace(b'banner', b'\xff\xfe') +
+                      ''.join(self.rows).encode())
+        for workers in (1, 3):
+            stats = {}
+            aggregates = parse_log(path, dict(TEST_CONFIG, WORKERS=workers, MAX_PARSE_ERRORS=5), stats)
+            self.assertEqual(aggregates[1], len(self.rows) + 1000)
+            self.assertEqual(stats, {'parse_errors': 1, 'truncated': False, 'read_error': False, 'cached': False})
+
+    def test_truncated_gz_keeps_partial_aggregates(self):
+        path = self.write_log('nginx-access-ui.log-20170630.gz', tied_rows(self.rows * 20))
+        with open(path, 'rb') as log:
+            data = log.read()
+        with open(path, 'wb') as log:
+            log.write(data[:len(data) // 2])
+        file_config = dict(TEST_CONFIG, CACHE_DIR=os.path.join(self.log_dir.name, 'cache'))
+        for options in ({'WORKERS': 1}, {'WORKERS': 3}, {'PIPELINE': 1}):
+            stats = {}
+            aggregates = parse_log(path, dict(file_config, **options), stats)
+            self.assertTrue(0 < aggregates[1] < len(self.rows) * 20)
+            self.assertEqual(stats, {'parse_errors': 0, 'truncated': True, 'read_error': True, 'cached': False})
+        self.assertFalse(aggregates_cache_path(path, file_config).exists())
+        report_path = Path(self.log_dir.name) / 'reports' / 'report-2017.06.30.html'
+        metrics = report_log(path, report_path, file_config)
+        self.assertTrue(metrics['truncated'])
+        self.assertFalse(report_path.exists())
+
+        file_config = dict(TEST_CONFIG, CACHE_DIR=os.path.join(self.log_dir.name, 'cache'))
+        path = self.write_log('nginx-access-ui.log-20170630.plain', self.rows)
+        aggregates = parse_log(path, file_config)
+        self.assertTrue(aggregates_cache_path(path, file_config).exists())
+        with patch('log_analyzer.aggregate_log_rows') as aggregate_log_rows:
+            self.assertEqual(parse_log(path, file_config), aggregates)
+            aggregate_log_rows.assert_not_called()
+        # Changed log and changed aggregation parameters invalidate the cache
+        with open(path, 'a') as log:
+            log.write(LOG_ROWS[0])
+        self.assertEqual(parse_log(path, file_config)[1], len(self.rows) + 1)
+        file_config['QUANTILE_ACCURACY'] = 0.02
+        self.assertEqual(parse_log(path, file_config)[0][LOG_ROWS[0].split('"')[1]].med.accuracy, 0.02)
+
+    def test_aggregates_cache_format(self):
+        path = self.write_log('nginx-access-ui.log-20170630.plain', tied_rows(self.rows))
+        for params in ({'MAX_URLS': 50}, {'TIME_BUCKET': 'minute', 'GROUP_BY': 'request,status'}):
+            file_config = dict(TEST_CONFIG, CACHE_DIR=os.path.join(self.log_dir.name, 'cache'), **params)
+            aggregates = parse_log(path, file_config)
+            stats = {}
+            self.assertEqual(parse_log(path, file_config, stats), aggregates)
+            self.assertTrue(stats['cached'])
+        # The cache is in REPORT_DIR by default, a file which is not a cache file is not loaded
+        file_config = dict(TEST_CONFIG, CACHE_DIR=None, REPORT_DIR=os.path.join(self.log_dir.name, 'reports'))
+        cache_path = aggregates_cache_path(path, file_config)
+        self.assertEqual(cache_path.parent, Path(self.log_dir.name, 'reports', '.cache'))
+        cache_path.parent.mkdir(parents=True)
+        cache_path.write_bytes(pickle.dumps(aggregates))
+        with patch('pickle.loads') as loads, patch('pickle.load') as load:
+            self.assertEqual(parse_log(path, file_config), parse_log(path, TEST_CONFIG))
+        loads.assert_not_called()
+        load.assert_not_called()
+        self.assertTrue(cache_path.read_bytes().startswith(b'LACACHE'))
+
+    def test_incremental_parse(self):
+        file_config = dict(TEST_CONFIG, CACHE_DIR=os.path.join(self.log_dir.name, 'cache'), INCREMENTAL=1)
+        path = self.write_log('nginx-access-ui.log-20170630.plain', self.rows[:1000])
+        self.assertEqual(parse_log(path, file_config)[1], 1000)
+        # Appended rows are parsed from the checkpoint, the row without line end is left for the next run
+        with open(path, 'a') as log:
+            log.writelines(self.rows[1000:2000])
+            log.write(self.rows[2000][:20])
+        with patch('log_analyzer.read_log_chunk', wraps=read_log_chunk) as read_chunk:
+            aggregates = parse_log(path, file_config)
+        self.assertEqual(read_chunk.call_args[0][1], len(''.join(self.rows[:1000]).encode()))
+        self.assertEqual(report_rows(aggregates), report_rows(parse_log(self.write_log('whole.plain', self.rows[:2000]),
+                                                                        TEST_CONFIG)))
+        with open(path, 'a') as log:
+            log.write(self.rows[2000][20:])
+        self.assertEqual(parse_log(path, dict(file_config, WORKERS=3))[1], 2001)
+        # Truncated and rotated logs are parsed from the start
+        self.write_log('nginx-access-ui.log-20170630.plain', self.rows[2000:2500] + self.rows[:1600])
+        self.assertEqual(parse_log(path, file_config)[1], 2100)
+        os.rename(path, path + '.1')
+        self.write_log('nginx-access-ui.log-20170630.plain', self.rows[:5])
+        self.assertEqual(parse_log(path, file_config)[1], 5)
+
+    def test_rollup_is_equal_to_one_log(self):
+        rows = tied_rows(self.rows)
+        files = [self.write_log('nginx-access-ui.log-2017062{}.gz'.format(day), rows[day::3]) for day in range(3)]
+        whole = self.write_log('nginx-access-ui.log-20170630.plain', [row for day in range(3) for row in rows[day::3]])
+        file_config = dict(TEST_CONFIG, CACHE_DIR=os.path.join(self.log_dir.name, 'cache'), WORKERS=2)
+        parse_log(files[1], file_config)
+        self.assertEqual(report_html(rollup_logs(files, file_config), self.log_dir.name),
+                         report_html(parse_log(whole, TEST_CONFIG), self.log_dir.name))
+
+    def test_rollup_stats(self):
+        files = [self.write_log('nginx-access-ui.log-2017062{}.plain'.format(day), self.rows[:500] + ['garbage\n'] * day)
+                 for day in range(3)]
+        file_config = dict(TEST_CONFIG, CACHE_DIR=os.path.join(self.log_dir.name, 'cache'), MAX_PARSE_ERRORS=1)
+        for workers in (1, 2):
+            stats = {}
+            self.assertEqual(rollup_logs(files, dict(file_config, WORKERS=workers), stats)[1], 1500)
+            self.assertEqual(stats, {'parse_errors': 3, 'truncated': True, 'read_error': False, 'cached': False})
+        stats = {}
+        rollup_logs(files[:1], file_config, stats)
+        self.assertEqual(stats, {'parse_errors': 0, 'truncated': False, 'read_error': False, 'cached': True})
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.file_config = dict(TEST_CONFIG, LOG_DIR=os.path.join(self.temp_dir.name, 'log'),
+                                REPORT_DIR=os.path.join(self.temp_dir.name, 'reports'), WATCH_INTERVAL=0)
+        os.mkdir(self.file_config['LOG_DIR'])
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def write_log(self, name):
+        with gzip.open(os.path.join(self.file_config['LOG_DIR'], name), 'wt', encoding='utf-8') as log:
+            log.writelines(LOG_ROWS)
+
+    def test_new_logs_are_reported(self):
+        reports = set()
+        for day in (28, 29):
+            self.write_log('nginx-access-ui.log-201706{}.gz'.format(day))
+            with patch('log_analyzer.report_log', wraps=report_log) as report:
+                watch(self.file_config, polls=3)
+            # Only the new log is reported
+            report.assert_called_once()
+            reports.add('report-2017.06.{}.html'.format(day))
+            self.assertEqual(set(os.listdir(self.file_config['REPORT_DIR'])), reports)
+        self.write_log('nginx-access-ui.log-20170630.gz')
+        watch(dict(self.file_config, WORKERS=2), polls=3)
+        self.assertEqual(set(os.listdir(self.file_config['REPORT_DIR'])), reports | {'report-2017.06.30.html'})
+
+    def test_newest_dated_logs_are_reported(self):
+        for name in ('nginx-access-ui.log-2017.plain', 'nginx-access-ui.log-20170627.gz',
+                     'nginx-access-ui.log-20170628.gz', 'nginx-access-ui.log-20170629.gz'):
+            self.write_log(name)
+        watch(dict(self.file_config, LOGS_COUNT=2), polls=2)
+        self.assertEqual(set(os.listdir(self.file_config['REPORT_DIR'])),
+                         {'report-2017.06.28.html', 'report-2017.06.29.html'})
+
+    def test_report_in_progress_is_not_reported(self):
+        with patch('log_analyzer.scan_logs', side_effect=[{'/log/nginx-access-ui.log-20170630.gz': (1, 1)},
+                                                          {'/log/nginx-access-ui.log-20170630.gz': (2, 2)}]), \
+                patch('log_analyzer.report_log') as report:
+            watch(self.file_config, polls=2)
+        report.assert_not_called()
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.file_config = dict(TEST_CONFIG, LOG_DIR=os.path.join(self.temp_dir.name, 'log'), LOGS_COUNT=2,
+                                REPORT_DIR=os.path.join(self.temp_dir.name, 'reports'), MAX_PARSE_ERRORS=1,
+                                METRICS_JSON=os.path.join(self.temp_dir.name, 'metrics.json'),
+                                METRICS_TEXTFILE=os.path.join(self.temp_dir.name, 'log_analyzer.prom'))
+        os.mkdir(self.file_config['LOG_DIR'])
+        for day, rows in ((29, LOG_ROWS * 10), (30, LOG_ROWS + ['garbage\n'] * 2 + LOG_ROWS)):
+            with open(os.path.join(self.file_config['LOG_DIR'], 'nginx-access-ui.log-201706{}.plain'.format(day)),
+                      'w') as log:
+                log.writelines(rows)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_run_metrics(self):
+        main(self.file_config)
+        with open(self.file_config['METRICS_JSON']) as metrics_file:
+            metrics = json.load(metrics_file)
+        self.assertEqual((metrics['rows'], metrics['parse_errors'], metrics['truncated_logs']), (55, 2, 1))
+        self.assertEqual(set(metrics['stages']), {'discovery', 'parse', 'aggregate', 'enrich', 'render'})
+        self.assertEqual([Path(log['log']).name for log in metrics['logs']],
+                         ['nginx-access-ui.log-20170630.plain', 'nginx-access-ui.log-20170629.plain'])
+        self.assertTrue(metrics['logs'][0]['truncated'])
+        self.assertGreater(metrics['logs'][1]['rows_per_sec'], 0)
+        self.assertGreaterEqual(metrics['peak_rss_bytes'], 0)
+        with open(self.file_config['METRICS_TEXTFILE']) as textfile:
+            lines = textfile.read().splitlines()
+        self.assertIn('# TYPE log_analyzer_parse_errors gauge', lines)
+        self.assertIn('log_analyzer_parse_errors 2.0', lines)
+        self.assertIn('log_analyzer_log_truncated{log="nginx-access-ui.log-20170630.plain"} 1.0', lines)
+        self.assertTrue(any(line.startswith('log_analyzer_stage_seconds{stage="render"} ') for line in lines))
+        for directory in {os.path.dirname(self.file_config[name]) for name in ('METRICS_JSON', 'METRICS_TEXTFILE')}:
+            self.assertEqual([name for name in os.listdir(directory) if name.endswith('.tmp')], [])
+
+    def test_label_values_are_escaped(self):
+        metrics = run_metrics([], {}, 0)
+        metrics['logs'] = [{'log': 'a"b\\c', 'rows': 1, 'rows_per_sec': 0, 'parse_errors': 0, 'truncated': False}]
+        self.assertIn('log_analyzer_log_rows{log="a\\"b\\\\c"} 1.0', prometheus_metrics(metrics).splitlines())
+
+
+class TestFindLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.log_dir = os.path.join(self.temp_dir.name, 'log')
+        self.file_config = dict(TEST_CONFIG, CACHE_DIR=os.path.join(self.temp_dir.name, 'cache'))
+        os.mkdir(self.log_dir)
+        for name in ('nginx-access-ui.log-20170629.gz', 'nginx-access-ui.log-20170701.plain',
+                     'nginx-access-ui.log-20170630.gz', 'nginx-access-ui.log-20171340.gz',
+                     'nginx-access-ui.log-20170801.bz2', 'nginx-access-api.log-20170801.gz'):
+            Path(self.log_dir, name).touch()
+        # The listing of a dir modified within a second is not cached
+        os.utime(self.log_dir, (time.time() - 10, time.time() - 10))
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_newest_logs(self):
+        logs = find_logs(self.log_dir, 'nginx-access-ui*', 2, self.file_config)
+        self.assertEqual(logs, [(date(2017, 7, 1), Path(self.log_dir, 'nginx-access-ui.log-20170701.plain')),
+                                (date(2017, 6, 30), Path(self.log_dir, 'nginx-access-ui.log-20170630.gz'))])
+        self.assertEqual(len(find_logs(self.log_dir, 'nginx-access-*', 10, self.file_config)), 4)
+        self.assertEqual(find_logs(os.path.join(self.temp_dir.name, 'missing'), '*', 2, self.file_config), [])
+
+    def test_listing_is_cached_by_dir_mtime(self):
+        logs = find_logs(self.log_dir, 'nginx-access-ui*', 5, self.file_config)
+        with patch('log_analyzer.os.scandir') as scandir:
+            self.assertEqual(find_logs(self.log_dir, 'nginx-access-ui*', 5, self.file_config), logs)
+            scandir.assert_not_called()
+        Path(self.log_dir, 'nginx-access-ui.log-20170702.gz').touch()
+        self.assertEqual(find_logs(self.log_dir, 'nginx-access-ui*', 1, self.file_config)[0][0], date(2017, 7, 2))
+        self.assertEqual(log_report_path(logs[0][1], TEST_CONFIG),
+                         Path(TEST_CONFIG['REPORT_DIR'], 'report-2017.07.01.html'))
+
+
+class TestParallelLogs(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.file_config = dict(TEST_CONFIG, LOG_DIR=os.path.join(self.temp_dir.name, 'log'), LOGS_COUNT=5)
+        os.mkdir(self.file_config['LOG_DIR'])
+        for day, copies in ((26, 10), (27, 30), (28, 20), (29, 40), (30, 1)):
+            with open(os.path.join(self.file_config['LOG_DIR'], 'nginx-access-ui.log-201706{}.plain'.format(day)),
+                      'w') as log:
+                log.writelines(LOG_ROWS * copies)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def read_reports(self, report_dir):
+        reports = {}
+        for name in os.listdir(report_dir):
+            with open(os.path.join(report_dir, name)) as report:
+                reports[name] = report.read()
+        return reports
+
+    def test_reports_are_equal_to_sequential(self):
+        sequential = os.path.join(self.temp_dir.name, 'sequential')
+        parallel = os.path.join(self.temp_dir.name, 'parallel')
+        main(dict(self.file_config, REPORT_DIR=sequential))
+        main(dict(self.file_config, REPORT_DIR=parallel, PARALLEL_LOGS=3, PARALLEL_LOGS_BYTES=30000))
+        self.assertEqual(len(os.listdir(parallel)), 5)
+        self.assertEqual(self.read_reports(parallel), self.read_reports(sequential))
+
+    def test_largest_logs_are_started_first_within_bytes(self):
+        class Pool:
+            started = []
+
+            def apply_async(self, func, args, callback, error_callback):
+                self.started.append(Path(args[0]).name[-14:-6])
+                callback({'log': args[0]})
+
+        logs = [(file, file.with_suffix('.html')) for file in sorted(Path(self.file_config['LOG_DIR']).iterdir())]
+        size = os.path.getsize(logs[0][0]) // 10
+        with patch('log_analyzer.worker_pool', return_value=nullcontext(Pool())):
+            metrics = report_logs(logs, dict(self.file_config, PARALLEL_LOGS=2, PARALLEL_LOGS_BYTES=size * 55))
+        # The log of 40 copies is started first, the log of 10 copies is the largest one which fits with it
+        self.assertEqual(Pool.started, ['20170629', '20170626', '20170627', '20170628', '20170630'])
+        self.assertEqual([metric['log'] for metric in metrics], [str(file) for file, _ in logs])
+
+
+class TestStore(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.file_config = dict(TEST_CONFIG, STORE_DB=os.path.join(self.temp_dir.name, 'store', 'store.sqlite'))
+        self.url = 'GET /api/v2/banner/25019354 HTTP/1.1'
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def test_report_log_replaces_day(self):
+        log = os.path.join(self.temp_dir.name, 'nginx-access-ui.log-20170629.plain')
+        report_path = Path(self.temp_dir.name) / 'report.html'
+        for copies in (3, 2):
+            with open(log, 'w') as f:
+                f.writelines(LOG_ROWS * copies)
+            metrics = report_log(log, report_path, self.file_config)
+        self.assertIn('store', metrics['stages'])
+        urls_list, sum_requests, _ = parse_log(log, self.file_config)
+        expected = enrich_url_statistics([urls_list[self.url]], sum_requests, total_request_time(urls_list))
+        with closing(open_store(self.file_config['STORE_DB'], read_only=True)) as connection:
+            self.assertEqual(connection.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            self.assertEqual(connection.execute('SELECT day, requests FROM days').fetchall(), [('2017-06-29', 10)])
+            self.assertEqual(connection.execute('SELECT COUNT(*) FROM url_stats').fetchone()[0], 4)
+            trend = url_trend(connection, self.url, date(2017, 6, 1), date(2017, 6, 30))
+        self.assertEqual(trend, [dict(expected[0], day='2017-06-29')])
+
+    def test_top_urls_over_days(self):
+        for day, rows in ((date(2017, 6, 29), LOG_ROWS[:3]), (date(2017, 6, 30), LOG_ROWS[3:] * 2)):
+            aggregates = aggregate_log_rows(rows)
+            store_aggregates(aggregates[:2] + (total_request_time(aggregates[0]),), day, 'log', self.file_config)
+        urls_list, sum_requests, _ = aggregate_log_rows(LOG_ROWS[:3] + LOG_ROWS[3:] * 2)
+        expected = enrich_url_statistics(top_url_statistics(urls_list, 2), sum_requests, total_request_time(urls_list))
+        with closing(open_store(self.file_config['STORE_DB'], read_only=True)) as connection:
+            self.assertEqual(top_urls(connection, date(2017, 6, 29), date(2017, 6, 30), 2), expected)
+            self.assertEqual([el['url'] for el in top_urls(connection, date(2017, 6, 30), date(2017, 6, 30))],
+                             ['GET /api/v2/slot/4705/groups HTTP/1.1', self.url])
+
+    def test_group_by_is_stored_by_request(self):
+        for group_by, day in (('request', date(2017, 6, 29)), ('request,status', date(2017, 6, 30))):
+            file_config = dict(self.file_config, GROUP_BY=group_by)
+            aggregates = aggregate_log_rows(LOG_ROWS, file_config)
+            store_aggregates(aggregates[:2] + (total_request_time(aggregates[0]),), day, 'log', file_config)
+        store_aggregates(aggregate_log_rows(LOG_ROWS, dict(self.file_config, GROUP_BY='status')), date(2017, 7, 1),
+                         'log', dict(self.file_config, GROUP_BY='status'))
+        with closing(open_store(self.file_config['STORE_DB'], read_only=True)) as connection:
+            days = [top_urls(connection, day, day) for day in (date(2017, 6, 29), date(2017, 6, 30))]
+            self.assertEqual(connection.execute('SELECT COUNT(*) FROM days').fetchone()[0], 2)
+        self.assertEqual(days[0], days[1])
+
+    def test_query_cli(self):
+        aggregates = aggregate_log_rows(LOG_ROWS)
+        store_aggregates(aggregates[:2] + (total_request_time(aggregates[0]),), date(2017, 6, 30), 'log',
+                         self.file_config)
+        with patch('sys.stdout', new_callable=io.StringIO) as stdout:
+            report = store_main(store_args(['--db', self.file_config['STORE_DB'], '--days', '90', 'trend', self.url]))
+        self.assertEqual([el['count'] for el in report], [2])
+        self.assertEqual(stdout.getvalue().splitlines()[1].split('\t')[:2], ['2017-06-30', '2'])
+        with self.assertRaises(sqlite3.Error):
+            store_main(store_args(['--db', os.path.join(self.temp_dir.name, 'missing.sqlite'), 'top']))
+
+
+class TestSpill(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        rnd = random.Random(6)
+        self.rows = [banner_row(rnd.randint(1, 50), rnd.random()) for _ in range(3000)]
+        self.file_config = dict(TEST_CONFIG, SPILL_URLS=10, SPILL_PARTITIONS=4, SPILL_DIR=self.temp_dir.name,
+                                TIME_BUCKET='hour')
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def report(self, aggregates):
+        report_path = Path(self.temp_dir.name) / 'report.html'
+        with patch('log_analyzer.create_report') as create_report:
+            build_report(aggregates, report_path, 20)
+        return create_report.call_args[0][0], create_report.call_args[0][2]
+
+    def test_spilled_report_is_equal_to_report_in_memory(self):
+        exact = aggregate_log_rows(self.rows, dict(self.file_config, SPILL_URLS=0))
+        for params in ({}, {'BINARY': 1}):
+            rows = [row.encode() for row in self.rows] if params else self.rows
+            urls_list, sum_requests, _ = aggregate_log_rows(rows, dict(self.file_config, **params))
+            self.assertTrue(urls_list.spilled)
+            self.assertLessEqual(len(urls_list), 10)
+            aggregates = urls_list, sum_requests, total_request_time(urls_list)
+            self.assertEqual(aggregates[1:], (exact[1], total_request_time(exact[0])))
+            self.assertEqual(self.report(aggregates),
+                             self.report((exact[0], exact[1], total_request_time(exact[0]))))
+            partitions = list(url_partitions(urls_list))
+            self.assertEqual(len(partitions), 4)
+            self.assertEqual(sum(len(part) for part in partitions), len(exact[0]))
+        # Partition files are removed with the table
+        del urls_list, aggregates, partitions
+        self.assertEqual(os.listdir(self.temp_dir.name), [])
+
+    def test_spilled_rollup(self):
+        files = []
+        for day in range(3):
+            files.append(os.path.join(self.temp_dir.name, 'nginx-access-ui.log-2017062{}.plain'.format(day)))
+            with open(files[-1], 'w') as log:
+                log.writelines(self.rows[day::3])
+        exact = rollup_logs(files, dict(self.file_config, SPILL_URLS=0))
+        for workers in (1, 2):
+            aggregates = rollup_logs(files, dict(self.file_config, WORKERS=workers))
+            self.assertTrue(aggregates[0].spilled)
+            self.assertEqual(self.report(aggregates), self.report(exact))
+
+
+class TestSample(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        rnd = random.Random(5)
+        self.rows = [banner_row(url, rnd.expovariate(1 / url)) for url in rnd.choices((1, 2, 3, 4), k=40000)]
+
+    def tearDown(self):
+        self.log_dir.cleanup()
+
+    def test_sample_range(self):
+        for sample in (0, '0', '0.01', '1'):
+            self.assertTrue(valid_sample(sample))
+        for sample in ('2', '-0.1', 'nan', 'inf', 'half'):
+            self.assertFalse(valid_sample(sample))
+
+    def test_sampled_report(self):
+        checks, misses = 0, 0
+        for name in ('nginx-access-ui.log-20170630.plain', 'nginx-access-ui.log-20170630.gz'):
+            path = os.path.join(self.log_dir.name, name)
+            with (gzip.open(path, 'wt') if name.endswith('gz') else open(path, 'w')) as log:
+                log.writelines(self.rows)
+            exact = {el['url']: el for el in report_rows(parse_log(path, TEST_CONFIG))}
+            for seed in range(10):
+                file_config = dict(TEST_CONFIG, SAMPLE=0.1, SAMPLE_SEED=str(seed))
+                aggregates, sample_rate = sample_log(path, file_config)
+                self.assertAlmostEqual(aggregates[1] / len(self.rows), sample_rate, delta=0.02)
+                urls_list = sorted(aggregates[0].values(), key=lambda stat: stat.url)
+                sample = sample_url_statistics(report_rows(aggregates), urls_list, aggregates[1], aggregates[2],
+                                               math.fsum(stat.med.square_sum() for stat in urls_list), sample_rate)
+                self.assertEqual(len(sample), 4)
+                for el in sample:
+                    self.assertAlmostEqual(el['count'] / exact[el['url']]['count'], 1, delta=0.2)
+                    for column in ('count_perc', 'time_perc', 'med'):
+                        low, high = el[column + '_ci']
+                        checks += 1
+                        misses += not low <= exact[el['url']][column] <= high
+            # The same rows are sampled with the same seed
+            self.assertEqual(sample_log(path, file_config), (aggregates, sample_rate))
+        # 95% confidence intervals
+        self.assertLess(misses / checks, 0.1)
+        report_path = Path(self.log_dir.name) / 'report.sample.html'
+        build_report(aggregates, report_path, 10, sample_rate)
+        with open(report_path) as report:
+            self.assertIn('var sample = {};'.format(sample_rate), report.read())
+
+
+class TestTimeBuckets(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [row.replace('03:50:22', '{:02d}:{:02d}:22'.format(hour, minute))
+                     for hour in (3, 4, 5) for minute in (0, 30) for row in LOG_ROWS]
+
+    def test_series(self):
+        urls_list, sum_requests, _ = aggregate_log_rows(self.rows, dict(TEST_CONFIG, TIME_BUCKET='hour'))
+        stat = urls_list['GET /api/v2/banner/25019354 HTTP/1.1']
+        # 29/Jun/2017:03:00:00 +0300 is 2017-06-29 00:00 UTC
+        self.assertEqual(sorted(stat.series), [1498694400, 1498698000, 1498701600])
+        self.assertEqual([point.count for point in stat.series.values()], [4, 4, 4])
+        self.assertAlmostEqual(sum(point.time_sum for point in stat.series.values()), stat.time_sum)
+        series = series_statistics(total_series(urls_list.values()))
+        self.assertEqual([point['time'] for point in series],
+                         ['2017-06-29 00:00', '2017-06-29 01:00', '2017-06-29 02:00'])
+        self.assertEqual(sum(point['count'] for point in series), sum_requests)
+        minutes, _, _ = aggregate_log_rows([row.encode() for row in self.rows],
+                                           dict(TEST_CONFIG, TIME_BUCKET='minute', BINARY=1))
+        self.assertEqual(len(minutes['GET /api/v2/banner/25019354 HTTP/1.1'].series), 6)
+        self.assertIsNone(aggregate_log_rows(self.rows)[0]['GET /api/v2/banner/25019354 HTTP/1.1'].series)
+
+    def test_format_without_time_local(self):
+        log_format = UI_SHORT_FORMAT.replace('[$time_local]', '[$time_iso8601 $msec]')
+        with self.assertLogs('ParserWork', 'ERROR') as logs:
+            urls_list, sum_requests, errors = aggregate_log_rows(
+                self.rows, dict(TEST_CONFIG, TIME_BUCKET='hour', LOG_FORMAT=log_format))
+        self.assertEqual(logs.output, ['ERROR:ParserWork:TIME_BUCKET hour is ignored, LOG_FORMAT has no $time_local'])
+        self.assertEqual((sum_requests, errors), (len(self.rows), 0))
+        self.assertIsNone(urls_list['GET /api/v2/banner/25019354 HTTP/1.1'].series)
+
+    def test_merged_series_are_equal_to_one_part(self):
+        file_config = dict(TEST_CONFIG, TIME_BUCKET='hour')
+        whole, _, _ = aggregate_log_rows(self.rows, file_config)
+        urls_list, _, _ = aggregate_log_rows(self.rows[:13], file_config)
+        merge_url_statistics(urls_list, aggregate_log_rows(self.rows[13:], file_config)[0])
+        self.assertEqual(report_rows((urls_list, 30, 1)), report_rows((whole, 30, 1)))
+
+    def test_time_local_is_parsed_once_per_bucket(self):
+        rows = [row.replace(':22 +', ':{:02d} +'.format(second)) for second in range(60) for row in self.rows]
+        with patch('log_analyzer.time_bucket_start', wraps=time_bucket_start) as bucket_start:
+            aggregate_log_rows(rows, dict(TEST_CONFIG, TIME_BUCKET='minute'))
+        self.assertEqual(bucket_start.call_count, 6)
+        self.assertEqual(time_bucket_start('29/Jun/2017:03', '+0530', TIME_BUCKETS['hour'][0]), 1498685400)
+
+
+class TestCreateReport(unittest.TestCase):
+
+    def setUp(self):
+        self.report_dir = tempfile.TemporaryDirectory()
+        self.rows = report_rows(aggregate_log_rows(LOG_ROWS * 3000)[:2] + (1.,)) * 700
+
+    def tearDown(self):
+        self.report_dir.cleanup()
+
+    def read_table(self, report_path):
+        with open(report_path) as report:
+            html = report.read()
+        return json.loads(html.split('var table = ')[1].split(';\n')[0]), \
+            json.loads(html.split('var tableUrl = ')[1].split(';\n')[0])
+
+    def test_inline_rows(self):
+        report_path = Path(self.report_dir.name) / 'report-2017.06.30.html'
+        create_report(self.rows, report_path)
+        self.assertEqual(self.read_table(report_path), (self.rows, None))
+        self.assertEqual(os.listdir(self.report_dir.name), ['report-2017.06.30.html'])
+
+    def test_sidecar_rows(self):
+        report_path = Path(self.report_dir.name) / 'report-2017.06.30.html'
+        create_report(self.rows, report_path, sidecar=True)
+        self.assertEqual(self.read_table(report_path), (None, 'report-2017.06.30.json.gz'))
+        with gzip.open(Path(self.report_dir.name) / 'report-2017.06.30.json.gz', 'rt') as sidecar:
+            self.assertEqual(json.load(sidecar), self.rows)
+        self.assertEqual(sorted(os.listdir(self.report_dir.name)), ['report-2017.06.30.html',
+                                                                   'report-2017.06.30.json.gz'])
+
+    def test_template_is_read_once(self):
+        create_report([], Path(self.report_dir.name) / 'report.html')
+        with patch('builtins.open', wraps=open) as opened:
+            create_report(self.rows[:10], Path(self.report_dir.name) / 'report.html')
+        self.assertEqual([call[0][0] for call in opened.call_args_list if str(call[0][0]).endswith('.html')], [])
+
+
+class TestGroupBy(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+        statuses = ('200', '404', '500', '502')
+        self.rows = [row.replace('" 200 ', '" {} '.format(statuses[(number + index) % 4]))
+                     for number in range(100) for index, row in enumerate(LOG_ROWS)]
+        self.file_config = dict(TEST_CONFIG, GROUP_BY='request,status')
+
+    def tearDown(self):
+        self.log_dir.cleanup()
+
+    def test_composite_keys(self):
+        urls_list, sum_requests, _ = aggregate_log_rows(self.rows, self.file_config)
+        self.assertEqual(sum_requests, len(self.rows))
+        self.assertEqual(len(urls_list), 16)
+        stat = urls_list[('GET /api/v2/banner/25019354 HTTP/1.1', '500')]
+        self.assertEqual(stat.count, 50)
+        # The key of the dict and of the statistics is the same tuple
+        self.assertTrue(all(key is stat.url for key, stat in urls_list.items()))
+        binary, _, _ = aggregate_log_rows([row.encode() for row in self.rows], dict(self.file_config, BINARY=1))
+        self.assertEqual(report_rows((binary, 1, 1)), report_rows((urls_list, 1, 1)))
+        report = enrich_url_statistics([stat], sum_requests, 1, ('request', 'status'))
+        self.assertEqual((report[0]['url'], report[0]['status']), stat.url)
+
+    def test_unknown_fields_are_ignored(self):
+        self.assertEqual(group_fields('status, unknown', UI_SHORT_FORMAT), ('status',))
+        self.assertEqual(group_fields('unknown', UI_SHORT_FORMAT), ('request',))
+        self.assertEqual(group_fields('request,request', UI_SHORT_FORMAT), ('request',))
+        statuses, _, _ = aggregate_log_rows(self.rows, dict(TEST_CONFIG, GROUP_BY='status'))
+        self.assertEqual(sorted(statuses), ['200', '404', '500', '502'])
+
+    def test_pivot_on_status(self):
+        report_path = Path(self.log_dir.name) / 'report.html'
+        build_report(aggregate_log_rows(self.rows, self.file_config)[:2] + (1.,), report_path, 10,
+                     file_config=dict(self.file_config, PIVOT='status'))
+        with open(report_path) as report:
+            table = json.loads(report.read().split('var table = ')[1].split(';\n')[0])
+        whole = {row['url']: row for row in report_rows(aggregate_log_rows(self.rows, TEST_CONFIG)[:2] + (1.,))}
+        self.assertEqual(len(table), 4)
+        for row in table:
+            self.assertEqual(row['count'], whole[row['url']]['count'])
+            self.assertAlmostEqual(row['time_sum'], whole[row['url']]['time_sum'])
+            self.assertEqual(row['med'], whole[row['url']]['med'])
+            self.assertAlmostEqual(sum(row['status_{}_perc'.format(status)] for status in ('200', '404', '500', '502')),
+                                   100)
+            self.assertEqual(row['error_perc'], row['status_500_perc'] + row['status_502_perc'])
+            self.assertNotIn('status', row)
+        self.assertEqual(table[0]['error_perc'], 50)
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.log_dir.cleanup()
+
+    def test_generated_logs_are_reproducible(self):
+        log_dir = Path(self.log_dir.name)
+        plain, gz = generate_logs(log_dir, 1, ['plain', 'gz'], lines=2000, urls=50, latency='pareto', seed='7')
+        self.assertEqual(plain.name, 'nginx-access-ui.log-20170630.plain')
+        with open(plain, 'rb') as plain_log, gzip.open(gz, 'rb') as gz_log:
+            rows = plain_log.read()
+            self.assertEqual(gz_log.read(), rows)
+        (log_dir / 'again').mkdir()
+        again = generate_log(log_dir / 'again' / plain.name, lines=2000, urls=50, latency='pareto', seed='7')
+        with open(again, 'rb') as again_log:
+            self.assertEqual(again_log.read(), rows)
+        urls_list, sum_requests, _ = parse_log(str(plain), TEST_CONFIG)
+        self.assertEqual(sum_requests, 2000)
+        self.assertLessEqual(len(urls_list), 50)
+
+    def test_results(self):
+        log_dir = Path(self.log_dir.name)
+        output = log_dir / 'results.json'
+        results = benchmark_main(parse_args(['--log-dir', str(log_dir / 'logs'), '--lines', '1000', '--urls', '20',
+                                             '--formats', 'gz', '--set', 'workers=2', '--output', str(output)]))
+        with open(output) as results_file:
+            self.assertEqual(json.load(results_file), results)
+        log = results['logs'][0]
+        self.assertEqual((log['file'], log['lines'], log['requests']), ('nginx-access-ui.log-20170630.gz', 1000, 1000))
+        self.assertEqual(sorted(log['stages']), ['create_report', 'enrich_url_statistics', 'parse_log', 'read_log'])
+        self.assertEqual(results['config']['WORKERS'], '2')
+        self.assertGreater(log['peak_rss_kb'], 0)
+        self.assertTrue(compare_results(results, results)[0].endswith('(+0.0%)'))
+
+
+class TestQuantileSketch(unittest.TestCase):
+
+    def test_quantiles_are_within_accuracy(self):
+        rnd = random.Random(1)
+        values = sorted(round(rnd.lognormvariate(-1, 1), 3) for _ in range(10001))
+        sketch = QuantileSketch(0.01)
+        for value in values:
+            sketch.add(value)
+        for q in (.5, .9, .95, .99):
+            exact = values[int(q * (len(values) - 1))]
+            self.assertLessEqual(abs(sketch.quantile(q) - exact) / exact, 0.01)
+
+    def test_quantiles_in_one_pass(self):
+        sketch = QuantileSketch()
+        for value in (0, 0, 0, 0.1, 0.39, 0.39, 1.2, 60.1):
+            sketch.add(value)
+        values = sketch.quantiles((.99, 0, .5, .3, 1))
+        self.assertEqual(values, [sketch.quantile(q) for q in (.99, 0, .5, .3, 1)])
+        self.assertEqual((values[1], values[3]), (0, 0))
+        self.assertAlmostEqual(values[2], 0.1, delta=0.1 * 0.01)
+        self.assertAlmostEqual(values[4], 60.1, delta=60.1 * 0.01)
+        self.assertEqual(QuantileSketch().quantiles((.5, .9)), [0, 0])
+
+    def test_merge(self):
+        left, right, whole = QuantileSketch(), QuantileSketch(), QuantileSketch()
+        for value in (0, 0.1, 0.39, 1.2):
+            left.add(value)
+            whole.add(value)
+        for value in (0.133, 60.1):
+            right.add(value)
+            whole.add(value)
+        left.merge(right)
+        self.assertEqual(left, whole)
+        with self.assertRaises(ValueError):
+            left.merge(QuantileSketch(0.05))
+
+    def test_bytes(self):
+        sketch = QuantileSketch(0.02)
+        for value in (0, 0, 0.001, 0.1, 0.39, 0.39, 1.2, 60.1):
+            sketch.add(value)
+        self.assertEqual(QuantileSketch.from_bytes(sketch.to_bytes()), sketch)
+        self.assertEqual(QuantileSketch.from_bytes(QuantileSketch().to_bytes()), QuantileSketch())
+
+
+class TestLogFormat(unittest.TestCase):
+
+    def test_extractor_is_equal_to_pattern(self):
+        fields = ('request', 'request_time', 'time_local', 'status', 'remote_addr')
+        extract = compile_log_format(UI_SHORT_FORMAT, fields)
+        pattern = log_format_pattern(UI_SHORT_FORMAT, fields)
+        for row in LOG_ROWS:
+            self.assertEqual(extract(row), pattern.match(row).group(*fields))
+        self.assertEqual(extract(LOG_ROWS[0])[:4],
+                         ('GET /api/v2/banner/25019354 HTTP/1.1', '0.390', '29/Jun/2017:03:50:22 +0300', '200'))
+
+    def test_statistics_are_equal_to_pattern(self):
+        rows = [row for _ in range(100) for row in LOG_ROWS]
+        pattern = log_format_pattern(UI_SHORT_FORMAT)
+        urls_list = {}
+        for row in rows:
+            data = pattern.match(row)
+            calculate_url_statistics(urls_list, data.group('request'), float(data.group('request_time')))
+        self.assertEqual(aggregate_log_rows(rows), (urls_list, len(rows), 0))
+
+    def test_missing_variables_are_config_error(self):
+        log_format = UI_SHORT_FORMAT.replace(' $request_time', '')
+        with self.assertRaises(ValueError):
+            compile_log_format(log_format)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            file_config = dict(TEST_CONFIG, LOG_FORMAT=log_format, LOG_DIR=temp_dir,
+                               REPORT_DIR=os.path.join(temp_dir, 'reports'))
+            with open(os.path.join(temp_dir, 'nginx-access-ui.log-20170630.plain'), 'w') as log:
+                log.writelines(LOG_ROWS)
+            with self.assertLogs('ParserWork', 'ERROR') as logs:
+                main(file_config)
+            self.assertEqual(logs.output, ['ERROR:ParserWork:LOG_FORMAT has no $request_time, logs are not parsed'])
+            self.assertFalse(os.path.exists(file_config['REPORT_DIR']))
+
+    def test_binary_extractor(self):
+        extract = compile_log_format(UI_SHORT_FORMAT, ('request', 'time_local', 'request_time'), binary=True)
+        self.assertEqual(extract(LOG_ROWS[0].encode()),
+                         (b'GET /api/v2/banner/25019354 HTTP/1.1', b'29/Jun/2017:03:50:22 +0300', b'0.390'))
+        self.assertEqual(extract(LOG_ROWS[-1].encode())[0], b'GET /api/v2/banner/25019354 HTTP/1.1')
+        self.assertIsNone(extract(b'garbage\n'))
+
+    def test_nginx_config_format(self):
+        log_format = ("'$remote_addr - $remote_user [$time_local] \"$request\" '\n"
+                      "'$status $body_bytes_sent \"$http_referer\" \"$http_user_agent\" $request_time'")
+        row = '127.0.0.1 - - [29/Jun/2017:03:50:22 +0300] "GET / HTTP/1.1" 200 12 "-" "curl/7.1" 0.002\n'
+        self.assertEqual(compile_log_format(log_format)(row), ('GET / HTTP/1.1', '0.002'))
+        self.assertEqual(aggregate_log_rows([row], dict(DEFAULT_CONFIG, LOG_FORMAT=log_format))[1:], (1, 0))
+
+    def test_malformed_row(self):
+        self.assertIsNone(compile_log_format(UI_SHORT_FORMAT)('garbage\n'))
+        self.assertEqual(aggregate_log_rows(LOG_ROWS[:2] + ['garbage\n'] + LOG_ROWS)[1:], (2, 1))
+
+
+class TestHeavyHitters(unittest.TestCase):
+
+    def setUp(self):
+        rnd = random.Random(2)
+        self.rows = [banner_row(rnd.choice((1, 2, rnd.randint(3, 1000))), rnd.random()) for _ in range(5000)]
+
+    def check_bounds(self, urls_list, exact):
+        self.assertLessEqual(len(urls_list), 10)
+        self.assertEqual(total_request_time(urls_list), total_request_time(exact))
+        for url, stat in exact.items():
+            if stat.time_sum > urls_list.floor:
+                self.assertIn(url, urls_list)
+            if url in urls_list:
+                approx = urls_list[url]
+                self.assertLessEqual(approx.time_sum - approx.time_sum_error, stat.time_sum + 1e-6)
+                self.assertGreaterEqual(approx.time_sum, stat.time_sum - 1e-6)
+
+    def test_space_saving_bounds(self):
+        exact, _, _ = aggregate_log_rows(self.rows)
+        urls_list, sum_requests, _ = aggregate_log_rows(self.rows, dict(DEFAULT_CONFIG, MAX_URLS=10))
+        self.assertEqual(sum_requests, len(self.rows))
+        self.assertLessEqual(urls_list.floor, total_request_time(exact) / 10)
+        self.check_bounds(urls_list, exact)
+
+    def test_merge_bounds(self):
+        exact, _, _ = aggregate_log_rows(self.rows)
+        file_config = dict(DEFAULT_CONFIG, MAX_URLS=10)
+        urls_list, _, _ = aggregate_log_rows(self.rows[:2000], file_config)
+        merge_url_statistics(urls_list, aggregate_log_rows(self.rows[2000:], file_config)[0])
+        self.check_bounds(urls_list, exact)
+
+
+class TestUrlNormalize(unittest.TestCase):
+
+    def test_normalize_url(self):
+        normalize = url_normalizer('query,id,uuid,hex', 100)
+        self.assertEqual(normalize('GET /api/v2/banner/25019354 HTTP/1.1'), 'GET /api/v2/banner/{id} HTTP/1.1')
+        self.assertEqual(normalize('GET /api/v2/group/1823183/banners?wait=1m HTTP/1.1'),
+                         'GET /api/v2/group/{id}/banners HTTP/1.1')
+        self.assertEqual(normalize('GET /s/550e8400-e29b-41d4-a716-446655440000/7f3a9c2e11 HTTP/1.1'),
+                         'GET /s/{uuid}/{hex} HTTP/1.1')
+        self.assertEqual(url_normalizer('id', 100)('GET /api/v2/slot/4705/groups?x=1 HTTP/1.1'),
+                         'GET /api/v2/slot/{id}/groups?x=1 HTTP/1.1')
+        self.assertIsNone(url_normalizer('', 100))
+
+    def test_aggregation_by_normalized_url(self):
+        urls_list, sum_requests, _ = aggregate_log_rows(LOG_ROWS, dict(DEFAULT_CONFIG, URL_NORMALIZE='query,id'))
+        self.assertEqual(urls_list['GET /api/v2/banner/{id} HTTP/1.1'].count, 3)
+        self.assertIn('GET /api/{id}/photogenic_banners/list/ HTTP/1.1', urls_list)
+        self.assertEqual(sum(stat.count for stat in urls_list.values()), sum_requests)